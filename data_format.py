@@ -0,0 +1,247 @@
+# binary data files of the host scripts, replacing the .txt files written with np.savetxt
+#
+# a file is laid out as
+#   magic (4 bytes, b"PGD1") | header length (uint32, little-endian) | JSON header
+#   | chunk | chunk | ... | index | footer
+# the JSON header holds the dtype of the rows and the metadata of the experiment, the same as the "# ... #"
+# lines at the top of the .txt files. every chunk is
+#   b"ROWS" | kind (uint32) | rows (uint32) | columns (uint32) | rows x columns values of the dtype
+# where kind is "data" (shots or batch averages), "average" (the grand average) or "time" (the time row in ns),
+# padded so that every chunk starts on 8 bytes. the index is an array of (offset, kind, rows, columns) of
+# the chunks as uint64, and the footer is b"PGIX" | index offset (uint64) | number of chunks (uint64).
+#
+# a batch is appended as a single chunk, written straight from the numpy buffer, about 3 to 6 times smaller
+# than the text of np.savetxt and without any formatting. appending to a file drops its index and writes it
+# again when the file is closed. a file whose index was never written (e.g. the script was interrupted) can
+# still be read, its chunks are found by walking through them from the header.
+# the rows are read through a memory map, so reading one row of a large file (as plotter.py does) reads
+# only that row from the disk.
+
+import json
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"PGD1"
+PREFIX = struct.Struct("<4sI") # magic, header length
+CHUNK_MAGIC = b"ROWS"
+CHUNK = struct.Struct("<4sIII") # magic, kind, rows, columns
+INDEX_MAGIC = b"PGIX"
+FOOTER = struct.Struct("<4sQQ") # magic, index offset, number of chunks
+KINDS = ["data", "average", "time"]
+EXTENSION = ".pgd"
+
+def Padding(length):
+    # number of bytes that bring length to a multiple of 8
+    return -length % 8
+
+def ReadLayout(file):
+
+    """
+    This function reads the header and the chunk list of an open data file. It returns
+    (header, chunks, end, indexed), chunks being a list of (offset, kind, rows, columns) with the offset
+    of the values, end the offset after the last complete chunk, and indexed False if the index was missing.
+    """
+
+    file.seek(0, 2)
+    size = file.tell()
+    file.seek(0)
+
+    magic, header_length = PREFIX.unpack(file.read(PREFIX.size))
+    if magic != MAGIC:
+        raise ValueError(f"Not a data file, invalid magic: {magic!r}")
+    header = json.loads(file.read(header_length))
+    itemsize = np.dtype(header["dtype"]).itemsize
+    start = PREFIX.size + header_length
+
+    # the footer points to the index, if the file was closed properly
+    if size >= start + FOOTER.size:
+        file.seek(size - FOOTER.size)
+        magic, index_offset, count = FOOTER.unpack(file.read(FOOTER.size))
+        if magic == INDEX_MAGIC and index_offset + count * 32 + FOOTER.size == size:
+            file.seek(index_offset)
+            index = np.frombuffer(file.read(count * 32), dtype="<u8").reshape(count, 4)
+            chunks = [tuple(int(value) for value in chunk) for chunk in index]
+            return header, chunks, index_offset, True
+
+    # otherwise walk through the chunks, a chunk cut short at the end of the file is left out
+    chunks = []
+    offset = start
+    while offset + CHUNK.size <= size:
+        file.seek(offset)
+        magic, kind, rows, columns = CHUNK.unpack(file.read(CHUNK.size))
+        if magic != CHUNK_MAGIC:
+            break
+        length = rows * columns * itemsize
+        if offset + CHUNK.size + length > size:
+            break
+        chunks.append((offset + CHUNK.size, kind, rows, columns))
+        offset += CHUNK.size + length + Padding(length)
+
+    return header, chunks, min(offset, size), False
+
+class DataWriter:
+
+    # writes a data file, given the metadata it creates a new file, otherwise it appends to an existing one
+
+    def __init__(self, path, metadata = None, dtype = "<f8"):
+        self.path = path
+        if metadata is not None:
+            self.dtype = np.dtype(dtype)
+            header = json.dumps({"dtype": self.dtype.str, "metadata": metadata}, default=str).encode()
+            header += b" " * Padding(PREFIX.size + len(header))
+
+            self.file = open(path, "w+b")
+            self.file.write(PREFIX.pack(MAGIC, len(header)))
+            self.file.write(header)
+            self.chunks = []
+        else:
+            self.file = open(path, "r+b")
+            header, self.chunks, end, _ = ReadLayout(self.file)
+            self.dtype = np.dtype(header["dtype"])
+            self.file.truncate(end) # the index is written again on close
+            self.file.seek(end)
+
+    def append(self, rows, kind = "data"):
+
+        """
+        This function appends a 2D array of rows (or a single 1D row) as one chunk, converted to the
+        dtype of the file. kind is "data", "average" or "time".
+        """
+
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.ndim == 1:
+            rows = rows[np.newaxis, :]
+        if rows.ndim != 2:
+            raise ValueError("Rows must be a 1D or a 2D array")
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}")
+
+        self.file.write(CHUNK.pack(CHUNK_MAGIC, KINDS.index(kind), rows.shape[0], rows.shape[1]))
+        self.chunks.append((self.file.tell(), KINDS.index(kind), rows.shape[0], rows.shape[1]))
+        self.file.write(memoryview(rows).cast("B"))
+        self.file.write(b"\0" * Padding(rows.nbytes))
+
+    def flush(self):
+        # the chunks written so far are readable without the index, see ReadLayout()
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.chunks, dtype="<u8").reshape(-1, 4).tobytes())
+        self.file.write(FOOTER.pack(INDEX_MAGIC, index_offset, len(self.chunks)))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DataFile:
+
+    # reads a data file through a memory map, the arrays returned by chunk() and row() are read-only views into it
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            header, self.chunks, _, self.indexed = ReadLayout(file)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.dtype = np.dtype(header["dtype"])
+        self.metadata = header["metadata"]
+        self.starts = np.cumsum([0] + [rows for _, _, rows, _ in self.chunks]) # first row of every chunk
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def chunk(self, index):
+        offset, _, rows, columns = self.chunks[index]
+        return np.frombuffer(self.map, dtype=self.dtype, count=rows * columns, offset=offset).reshape(rows, columns)
+
+    def row(self, index):
+        # a single row, negative indices count from the end like for the rows of np.loadtxt
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Row {index} out of range, the file has {len(self)} rows")
+        chunk = int(np.searchsorted(self.starts, index, side="right")) - 1
+        return self.chunk(chunk)[index - self.starts[chunk]]
+
+    def rows(self, kind = None):
+        # all rows, or the rows of one kind, as a single array in memory
+        chunks = [self.chunk(i) for i, (_, chunk_kind, _, _) in enumerate(self.chunks) if kind is None or KINDS[chunk_kind] == kind]
+        if not chunks:
+            return np.empty((0, 0), dtype=self.dtype)
+        return np.concatenate(chunks)
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            pass # arrays returned by chunk() or row() are still in use, the map is closed once they are gone
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def HeaderLines(metadata):
+    # the "# ... #" lines of a .txt file for the metadata, an entry without a value is written as it is
+    return [f"# {key} #\n" if value is None else f"# {key}: {value} #\n" for key, value in metadata.items()]
+
+def ConvertTXTFile(txt_path, path = None, dtype = "<f8", block_rows = 1024):
+
+    """
+    This function converts a .txt file of the host scripts into a data file and returns its path
+    (by default the same name with the .pgd extension). The "# key: value #" lines become the metadata,
+    the second-to-last row is stored as the "average" and the last row as the "time" row. The rows are
+    converted block_rows at a time, so the .txt file does not have to fit in memory.
+    """
+
+    if path is None:
+        path = txt_path.rsplit(".", 1)[0] + EXTENSION
+
+    metadata = {}
+    block = []
+    with open(txt_path) as txt_file:
+        lines = iter(txt_file)
+        for line in lines:
+            if not line.startswith("#"):
+                if line.strip():
+                    block.append(line)
+                break
+            text = line.strip().strip("#").strip()
+            key, separator, value = text.partition(": ")
+            metadata[key] = value if separator else None
+
+        with DataWriter(path, metadata, dtype) as writer:
+            for line in lines:
+                if not line.strip():
+                    continue
+                block.append(line)
+                if len(block) >= block_rows + 2:
+                    # the last two rows are held back, they may be the average and the time row
+                    writer.append(np.loadtxt(block[:-2], delimiter=",", ndmin=2))
+                    block = block[-2:]
+
+            if len(block) > 2:
+                writer.append(np.loadtxt(block[:-2], delimiter=",", ndmin=2))
+            if len(block) >= 2:
+                writer.append(np.loadtxt(block[-2:-1], delimiter=","), "average")
+                writer.append(np.loadtxt(block[-1:], delimiter=","), "time")
+            elif block:
+                writer.append(np.loadtxt(block, delimiter=","))
+
+    return path
+
+if __name__ == "__main__":
+    # convert the .txt files given on the command line, e.g. python data_format.py data/*.txt
+    for txt_path in sys.argv[1:]:
+        print(f"{txt_path} -> {ConvertTXTFile(txt_path)}")
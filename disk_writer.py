@@ -0,0 +1,158 @@
+# background writer of the host scripts, the data files are written by a thread of their own
+#
+# the receive loop used to write every batch itself, reopening the file each time (four times per batch in the
+# decimated scripts), and the stream of the board was not read while the disk was busy. now the rows are handed
+# to a writer thread through a bounded queue and the receive loop goes straight back to the stream. the files
+# are kept open until finish() and flushed every FLUSH_INTERVAL seconds, so after a crash at most that much
+# data is lost (a .pgd file without its index is still readable, see data_format.py).
+#
+# a disk slower than the stream fills the queue, and only then does the receive loop wait for it. the depth of
+# the queue and the time the receive loop waited are kept, see depth() and stats(), so a slow disk is visible.
+# the rows handed over are written later, so they must not be modified after append().
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+from data_format import DataWriter
+
+QUEUE_DEPTH = 32 # appends waiting to be written, one per file and batch
+FLUSH_INTERVAL = 1.0 # seconds between the flushes of the open files
+
+class DiskWriter:
+
+    def __init__(self, depth = QUEUE_DEPTH, flush_interval = FLUSH_INTERVAL):
+        self.capacity = depth
+        self.flush_interval = flush_interval
+        self.items = queue.Queue(maxsize=depth)
+        self.thread = None # started by the first append
+        self.files = {} # path -> open file, only used by the writer thread
+        self.error = None
+
+        self.writes = 0
+        self.bytes = 0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0 # time the callers waited for room in the queue
+        self.max_depth = 0
+
+    def append(self, path, file_format, rows, kind = "data", fmt = "%.18e"):
+
+        """
+        This function queues rows to be appended to a data file created before (by StartDataFile), as a chunk of
+        the given kind for a .pgd file (file_format "binary") or as np.savetxt lines with fmt for a .txt file.
+        It only waits if the queue is full, and raises the error of an earlier write that failed.
+        """
+
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+        start = time.perf_counter()
+        self.items.put(("append", (path, file_format, rows, kind, fmt)))
+        self.wait_seconds += time.perf_counter() - start
+        self.max_depth = max(self.max_depth, self.items.qsize())
+
+    def depth(self):
+        # number of appends waiting to be written
+        return self.items.qsize()
+
+    def finish(self):
+
+        """
+        This function waits until everything queued is written, then closes the files (writing the index of the
+        .pgd files) and returns stats() of the writes since the last finish. It raises the error of a write that
+        failed, the rows queued after it were not written.
+        """
+
+        if self.thread is not None:
+            done = threading.Event()
+            self.items.put(("finish", done))
+            done.wait()
+
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+        stats = self.stats()
+        self.writes, self.bytes, self.write_seconds, self.wait_seconds, self.max_depth = 0, 0, 0.0, 0.0, 0
+        return stats
+
+    def close(self):
+        # finish and stop the thread, called in the cleanup of the scripts, so an error is printed instead of raised
+        try:
+            self.finish()
+        except Exception as e:
+            print(f"Error writing the data files: {e}")
+
+        if self.thread is not None:
+            self.items.put(("stop", None))
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        # writing statistics so far, times in seconds
+        return {
+            "writes": self.writes,
+            "bytes": self.bytes,
+            "write_seconds": self.write_seconds,
+            "wait_seconds": self.wait_seconds,
+            "max_depth": self.max_depth
+        }
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                kind, content = self.items.get(timeout=self.flush_interval)
+            except queue.Empty:
+                kind, content = None, None
+
+            if kind == "append" and self.error is None:
+                try:
+                    self.write(*content)
+                except Exception as e:
+                    self.error = e # raised by the next append or by finish, the rest of the run is not written
+            elif kind in ["finish", "stop"]:
+                self.close_files()
+                if kind == "stop":
+                    return
+                content.set()
+
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush_files()
+                last_flush = time.monotonic()
+
+    def write(self, path, file_format, rows, kind, fmt):
+        start = time.perf_counter()
+        if path not in self.files:
+            self.files[path] = open(path, "a") if file_format == "txt" else DataWriter(path)
+
+        if file_format == "txt":
+            np.savetxt(self.files[path], rows, fmt = fmt, delimiter = ",")
+        else:
+            self.files[path].append(rows, kind)
+
+        self.writes += 1
+        self.bytes += np.asarray(rows).nbytes
+        self.write_seconds += time.perf_counter() - start
+
+    def flush_files(self):
+        for file in self.files.values():
+            try:
+                file.flush()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def close_files(self):
+        for file in self.files.values():
+            try:
+                file.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+        self.files = {}
@@ -1,7 +1,19 @@
 ''' Some functions for RB support '''
 import numpy as np
-import pickle
-import cirq
+from functools import lru_cache
+
+@lru_cache(maxsize=64)
+def envelope(shape, si, length, maxv):
+    # memoized envelope, shared by every gate (and every program) using the same parameters.
+    # the array is read-only since it is shared, the gaussian is centered in its window
+    if shape == "gauss":
+        y = gauss(mu=length / 2, si=si, length=length, maxv=maxv)
+    elif shape == "zero":
+        y = np.zeros(length)
+    else:
+        raise ValueError(f"Unknown envelope shape: {shape}")
+    y.setflags(write=False)
+    return y
 
 def gauss(mu=0, si=0, length=100, maxv=30000):
     x = np.arange(0, length)
@@ -11,90 +23,54 @@ def gauss(mu=0, si=0, length=100, maxv=30000):
     return y
 
 def generate_2qgateset(config):
-    return {
-              "I": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": 0, "style": "arb",
+    # every gate is a gaussian of the same width, only the amplitude and the I/Q sign differ.
+    # the envelopes are built once and identical ones are the same array (see waveform_aliases)
+    si = 16 * config["pi_sigma"]
+    length = 4 * si
 
-              },
+    zero = envelope("zero", si, length, 0)
+    full = envelope("gauss", si, length, 32000)
+    negative = envelope("gauss", si, length, -32000)
+
+    return {
+              "I": {"idata": full, "qdata": zero, "phase": 0, "gain": 0, "style": "arb"},
             "sqrtiSWAP": {
-                "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                               length=4 * 16*config["pi_sigma"], maxv=5000),
-                "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                   length=4 * 16*config["pi_sigma"], maxv=5000),
+                "idata": envelope("gauss", si, length, 5000), "qdata": zero,
                 "phase": 0, "gain": config['pi_gain'], "style": "arb",
             },
             "sqrtbSWAP": {
-                "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                               length=4 * 16*config["pi_sigma"], maxv=10000),
-                "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                   length=4 * 16*config["pi_sigma"], maxv=10000),
+                "idata": envelope("gauss", si, length, 10000), "qdata": zero,
                 "phase": 0, "gain": config['pi_gain'], "style": "arb",
             },
-              "X": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": config['pi_gain'], "style": "arb",
-              },
-            "Y": {
-                "idata": 0 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                               length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "qdata": gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                                   length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "phase": 0, "gain": config['pi_gain'], "style": "arb",
-            },
-              "Z": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": 0, "style": "arb",
-              },
-              "X/2": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": config['pi_2_gain'], "style": "arb",
-              },
-            "-X/2": {
-                "idata": -1 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                               length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "qdata": 0 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                                   length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "phase": 0, "gain": config['pi_2_gain'], "style": "arb",
-            },
-              "Y/2": {
-                "idata": 0 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                               length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "qdata": gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                                   length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "phase": 0, "gain": config['pi_2_gain'], "style": "arb",
-              },
-            "-Y/2": {
-                "idata": 0 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                                   length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "qdata": -1 * gauss(mu=16 * config["pi_sigma"] * 4 / 2, si=16 * config["pi_sigma"],
-                               length=4 * 16 * config["pi_sigma"], maxv=32000),
-                "phase": 0, "gain": config['pi_2_gain'], "style": "arb",
-            },
-              "Z/2": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": 0, "style": "arb",
-              },
-              "-Z/2": {
-                  "idata": gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                 length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "qdata": 0 * gauss(mu=16*config["pi_sigma"] * 4 / 2, si=16*config["pi_sigma"],
-                                     length=4 * 16*config["pi_sigma"], maxv=32000),
-                  "phase": 0, "gain": 0, "style": "arb",
-              },
+              "X": {"idata": full, "qdata": zero, "phase": 0, "gain": config['pi_gain'], "style": "arb"},
+            "Y": {"idata": zero, "qdata": full, "phase": 0, "gain": config['pi_gain'], "style": "arb"},
+              "Z": {"idata": full, "qdata": zero, "phase": 0, "gain": 0, "style": "arb"},
+              "X/2": {"idata": full, "qdata": zero, "phase": 0, "gain": config['pi_2_gain'], "style": "arb"},
+            "-X/2": {"idata": negative, "qdata": zero, "phase": 0, "gain": config['pi_2_gain'], "style": "arb"},
+              "Y/2": {"idata": zero, "qdata": full, "phase": 0, "gain": config['pi_2_gain'], "style": "arb"},
+            "-Y/2": {"idata": zero, "qdata": negative, "phase": 0, "gain": config['pi_2_gain'], "style": "arb"},
+              "Z/2": {"idata": full, "qdata": zero, "phase": 0, "gain": 0, "style": "arb"},
+              "-Z/2": {"idata": full, "qdata": zero, "phase": 0, "gain": 0, "style": "arb"},
     }
+
+def waveform_aliases(gate_set, gate_seq):
+    # map every gate used in gate_seq to the name of the waveform to play for it. gates with
+    # identical I/Q data share one waveform, so only the values of the result need to be uploaded
+    aliases = {}
+    uploaded = []
+    for g in gate_seq:
+        for q in g:
+            name = g[q]
+            if name in aliases:
+                continue
+
+            ginfo = gate_set[name]
+            for other in uploaded:
+                oinfo = gate_set[other]
+                if all(ginfo[key] is oinfo[key] or np.array_equal(ginfo[key], oinfo[key]) for key in ["idata", "qdata"]):
+                    aliases[name] = other
+                    break
+            else:
+                uploaded.append(name)
+                aliases[name] = name
+    return aliases
@@ -0,0 +1,86 @@
+# integration of the decimated readout into one I/Q point per shot, used by the "integrated" mode of main_pulser_decimated.py
+#
+# the readout of the board already mixes the signal down with the readout frequency, so a shot is a short
+# complex trace. in integrated mode every trace is (optionally) demodulated once more with demod_freq, to
+# remove a residual detuning, and reduced to a single complex value with a weighted sum over the integration
+# window. the weights are either a boxcar or the matched envelope, i.e. the conjugate of the mean trace of the
+# first batch, which gives the best signal to noise ratio for a known pulse shape.
+
+import numpy as np
+
+WEIGHTINGS = ["boxcar", "matched"]
+MAX_HISTOGRAM_BINS = 1024
+
+def ComplexTraces(shots, time_row, demod_freq = 0):
+
+    """
+    This function turns shots indexed by (shot, channel, I/Q, sample) into complex traces indexed by
+    (shot, channel, sample), demodulated with demod_freq (in MHz, the time row is in us) if it is not zero.
+    """
+
+    traces = shots[:, :, 0] + 1j * shots[:, :, 1]
+    if demod_freq:
+        traces = traces * np.exp(-2j * np.pi * demod_freq * time_row)
+    return traces.astype(np.complex64, copy=False)
+
+def IntegrationWeights(traces, time_row, window_start = None, window_stop = None, weighting = "boxcar"):
+
+    """
+    This function returns the integration weights indexed by (channel, sample), zero outside the window.
+    window_start and window_stop are in ns, None means the start or the end of the readout. The matched
+    weights are taken from the traces (usually the first batch). The weights are normalized to a sum of 1
+    in absolute value, so the boxcar gives the mean of the trace over the window, and the matched weights
+    give the mean trace rotated onto the I axis.
+    """
+
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Invalid weighting: {weighting}, must be one of {WEIGHTINGS}")
+
+    time_ns = np.asarray(time_row) * 1e3
+    inside = np.ones(len(time_ns), dtype=bool)
+    if window_start is not None:
+        inside &= time_ns >= window_start
+    if window_stop is not None:
+        inside &= time_ns < window_stop
+    if not inside.any():
+        raise ValueError("The integration window does not contain any sample of the readout")
+
+    if weighting == "boxcar":
+        weights = np.broadcast_to(inside.astype(np.complex64), (traces.shape[1], len(time_ns))).copy()
+    else:
+        weights = np.conj(traces.mean(axis=0)) * inside
+
+    norm = np.abs(weights).sum(axis=1, keepdims=True)
+    norm[norm == 0] = 1 # a channel without signal keeps zero weights instead of dividing by zero
+    return (weights / norm).astype(np.complex64)
+
+def Integrate(traces, weights):
+
+    """
+    This function returns the weighted sum of every trace, one complex value per shot and channel.
+    """
+
+    return np.einsum("scn,cn->sc", traces, weights)
+
+def HistogramRange(values):
+
+    """
+    This function returns a square I/Q range around the integrated values, (low, high) for both axes,
+    so that the histograms of all batches share the same bins.
+    """
+
+    extent = max(np.abs(values.real).max(), np.abs(values.imag).max(), 1e-9) if values.size else 1.0
+    return -1.1 * extent, 1.1 * extent
+
+def IQHistograms(values, bins, value_range):
+
+    """
+    This function returns the 2D histograms of the integrated values indexed by (channel, I bin, Q bin).
+    The histograms of several batches with the same bins can be added up.
+    """
+
+    low, high = value_range
+    histograms = np.empty((values.shape[1], bins, bins), dtype=np.uint32)
+    for ch in range(values.shape[1]):
+        histograms[ch], _, _ = np.histogram2d(values[:, ch].real, values[:, ch].imag, bins=bins, range=[[low, high], [low, high]])
+    return histograms
@@ -0,0 +1,356 @@
+# asynchronous acquisition jobs on the board, used by server.py
+#
+# a job is submitted with POST /jobs and then runs on the acquisition worker independently of any
+# client connection. the last RETAINED_BATCHES batches it produced are kept in memory, so a client can
+# read the stream, drop the connection and resume from the last batch it received (as long as it is
+# still kept), or cancel the job with DELETE. the jobs of /run and of the TCP stream have a single reader
+# that is attached to them from the start (attached=True), so their batches are dropped as soon as the
+# reader has sent them, and the job waits for its reader once RETAINED_BATCHES batches are not sent yet.
+# either way the memory of a job does not grow with number_of_expt. the batches of an attached job are sent
+# straight from the shared memory of the worker (see shm_ring.py) and only copied if the job ends before
+# its reader has sent them.
+#
+# the board can only run one acquisition at a time, so jobs wait in a priority queue (higher priority
+# first, FIFO among equal priorities). the queue has a maximum length, beyond which new jobs are
+# rejected, and every queued job gets an estimated start time based on the measured speed of past jobs.
+
+import threading
+import heapq
+import itertools
+import time
+import uuid
+
+from worker import JobCancelled
+from shm_ring import SlotChunk
+from metrics import metrics
+from sweep import SweepPoints
+
+RETAINED_BATCHES = 16 # batches kept per job
+
+def IsBatch(chunk):
+
+    """
+    This function tells whether a chunk of the worker output is a batch. Binary frames are always
+    batches, the JSON stream also has the opening and closing brackets which are not.
+    """
+
+    if isinstance(chunk, SlotChunk):
+        return chunk.is_batch()
+    return isinstance(chunk, (bytes, bytearray)) or chunk.startswith("{")
+
+class QueueFull(RuntimeError):
+    # raised by JobManager.submit when too many jobs are waiting, retry_after is in seconds
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Job:
+
+    def __init__(self, data, attached = False):
+        self.id = uuid.uuid4().hex
+        self.data = data
+        self.format = "binary" if data.get("format") == "binary" else "json"
+        self.priority = int(data.get("priority", 0)) # higher priority jobs run first
+        self.number_of_expt = max(1, int(data.get("number_of_expt") or 1))
+        self.sweep_points = len(SweepPoints(data["sweep"])) if data.get("sweep") else 1 # number_of_expt experiments per point
+        self.status = "queued" # "queued", "running", "done", "failed" or "cancelled"
+        self.batches = [] # the kept part of the output of the job, one chunk per batch
+        self.first_batch = 0 # index of batches[0] in the output of the job
+        self.batch_count = 0 # batches produced so far
+        self.attached = attached # if True, a batch is dropped once the single reader of the job has sent it
+        self.sending = None # the SlotChunk the reader of an attached job is sending
+        self.error = None
+        self.cancel_requested = False
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def is_finished(self):
+        return self.status in ["done", "failed", "cancelled"]
+
+    def info(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "mode": self.data.get("mode"),
+            "format": self.format,
+            "priority": self.priority,
+            "number_of_expt": self.number_of_expt,
+            "sweep_points": self.sweep_points,
+            "batches": self.batch_count,
+            "first_kept_batch": self.first_batch,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+class JobManager:
+
+    def __init__(self, worker, max_queued_jobs = 8, max_finished_jobs = 8, default_seconds_per_expt = 0.01):
+        self.worker = worker
+        self.max_queued_jobs = max_queued_jobs # admission control, more waiting jobs than this are rejected
+        self.max_finished_jobs = max_finished_jobs # finished jobs kept for late readers, oldest are dropped first
+        self.jobs = {} # job id -> Job, in submission order
+        self.pending = [] # heap of (-priority, sequence, job)
+        self.sequence = itertools.count()
+        self.running = None
+        self.condition = threading.Condition() # guards the jobs and wakes up the runner and the readers of new batches
+        self.thread = None
+
+        # measured duration per experiment of each mode, used for the estimated start times.
+        # the default is a rough guess which is replaced after the first finished job
+        self.default_seconds_per_expt = default_seconds_per_expt
+        self.seconds_per_expt = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run_jobs, daemon=True)
+        self.thread.start()
+
+    def submit(self, data, attached = False):
+        # queue a new job, raises QueueFull if too many jobs are already waiting. see Job for attached
+        job = Job(data, attached)
+        with self.condition:
+            queued = [other for _, _, other in self.pending if other.status == "queued"]
+            if len(queued) >= self.max_queued_jobs:
+                raise QueueFull("Too many jobs are waiting for the board", self.estimated_wait(len(queued)))
+
+            self.jobs[job.id] = job
+            heapq.heappush(self.pending, (-job.priority, next(self.sequence), job))
+            self.condition.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        # cancel a queued or running job, returns the job or None if it does not exist
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_finished():
+                return job
+
+            if job.status == "running":
+                job.cancel_requested = True # the runner thread marks the job once the worker stopped
+                self.worker.cancel()
+                self.condition.notify_all() # the runner may be waiting for the reader of an attached job
+            else:
+                self.finish(job, "cancelled")
+            return job
+
+    def remove(self, job_id):
+        # drop a finished job together with its batches
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is not None and job.is_finished():
+                del self.jobs[job_id]
+            return job
+
+    def finish(self, job, status, error = None):
+        # must be called with self.condition held
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        self.condition.notify_all()
+        metrics.increment(f"jobs_{status}")
+
+        # learn the speed of the board from the jobs that ran to the end, smoothed over the last few jobs
+        if status == "done" and job.started is not None:
+            mode = job.data.get("mode")
+            measured = (job.finished - job.started) / (job.number_of_expt * job.sweep_points)
+            previous = self.seconds_per_expt.get(mode)
+            self.seconds_per_expt[mode] = measured if previous is None else 0.7 * previous + 0.3 * measured
+
+        # forget the oldest finished jobs together with their kept batches
+        finished = [other.id for other in self.jobs.values() if other.is_finished()]
+        for old_id in finished[:-self.max_finished_jobs]:
+            del self.jobs[old_id]
+
+    def run_jobs(self):
+        # body of the runner thread, runs the submitted jobs on the worker one by one
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+                _, _, job = heapq.heappop(self.pending)
+                if job.status != "queued": # cancelled while waiting
+                    continue
+                job.status = "running"
+                job.started = time.time()
+                self.running = job
+
+            stream = self.worker.run(job.data, copy=not job.attached) # the batches of an attached job stay in the ring until sent
+            try:
+                try:
+                    for chunk in stream:
+                        if job.cancel_requested:
+                            if isinstance(chunk, SlotChunk):
+                                chunk.release()
+                            raise JobCancelled() # closing the worker stream stops the job, in case the worker missed the cancel
+                        if IsBatch(chunk):
+                            self.keep(job, chunk)
+                        elif isinstance(chunk, SlotChunk):
+                            chunk.release() # the brackets of the JSON stream are added by stream()
+                finally:
+                    stream.close()
+                status, error = "done", None
+            except JobCancelled:
+                status, error = "cancelled", None
+            except Exception as e: # WorkerError, or the worker could not be restarted
+                status, error = "failed", str(e)
+
+            with self.condition:
+                self.running = None
+                self.detach(job)
+                self.finish(job, status, error)
+
+    def keep(self, job, chunk):
+        # add a batch to the output of a job, called by the runner thread
+        with self.condition:
+            # the reader of an attached job sends its batches in order, wait for it instead of piling them up.
+            # a reader that goes away cancels the job, which ends the wait
+            while job.attached and len(job.batches) >= RETAINED_BATCHES and not job.cancel_requested:
+                self.condition.wait()
+
+            job.batches.append(chunk)
+            job.batch_count += 1
+            if not job.attached and len(job.batches) > RETAINED_BATCHES:
+                del job.batches[0] # the oldest batch is only needed by a reader resuming from far behind
+                job.first_batch += 1
+            self.condition.notify_all()
+
+    def detach(self, job):
+        # copy the unsent batches of a finished job out of the ring, so that the next job does not wait for
+        # a reader that may be gone. the batch being sent is freed by its reader. must be called with self.condition held
+        for chunk in job.batches:
+            if isinstance(chunk, SlotChunk) and chunk is not job.sending:
+                chunk.detach()
+
+    def duration(self, job):
+        # estimated run time of a job in seconds
+        return job.number_of_expt * job.sweep_points * self.seconds_per_expt.get(job.data.get("mode"), self.default_seconds_per_expt)
+
+    def remaining(self, job):
+        # estimated time left for the running job, extrapolated from its own batches when possible
+        elapsed = time.time() - job.started
+        max_batch_size = max(1, int(job.data.get("max_batch_size") or 1000))
+        total_batches = -(-job.number_of_expt // max_batch_size) * job.sweep_points
+
+        if job.batch_count:
+            return max(0.0, elapsed / job.batch_count * total_batches - elapsed)
+        return max(0.0, self.duration(job) - elapsed)
+
+    def schedule(self):
+
+        """
+        This function returns the queued jobs in the order they will run, together with the estimated
+        number of seconds until each of them starts. Must be called with self.condition held.
+        """
+
+        wait = self.remaining(self.running) if self.running is not None else 0.0
+        order = []
+        for _, _, job in sorted(self.pending):
+            if job.status != "queued":
+                continue
+            order.append((job, wait))
+            wait += self.duration(job)
+        return order
+
+    def estimated_wait(self, position):
+        # estimated seconds until the job at the given queue position starts, must be called with self.condition held
+        order = self.schedule()
+        if position < len(order):
+            return order[position][1]
+        if order:
+            return order[-1][1] + self.duration(order[-1][0])
+        return self.remaining(self.running) if self.running is not None else 0.0
+
+    def info(self, job):
+        # status of a job including its place in the queue
+        with self.condition:
+            info = job.info()
+            info["queue_position"] = None
+            info["estimated_start"] = job.started
+
+            for position, (other, wait) in enumerate(self.schedule()):
+                if other is job:
+                    info["queue_position"] = position
+                    info["estimated_start"] = time.time() + wait
+            return info
+
+    def status(self):
+        # overview of the scheduler, for the /queue endpoint
+        with self.condition:
+            order = self.schedule()
+            return {
+                "running": self.running.id if self.running is not None else None,
+                "queued": [job.id for job, _ in order],
+                "max_queued_jobs": self.max_queued_jobs,
+                "estimated_idle": time.time() + self.estimated_wait(len(order)),
+                "seconds_per_expt": self.seconds_per_expt
+            }
+
+    def wait(self, job):
+        # wait until the job has its first batch or is finished
+        with self.condition:
+            while not job.batch_count and not job.is_finished():
+                self.condition.wait()
+
+    def stream(self, job, from_batch = 0):
+
+        """
+        This function yields the output of a job starting from the given batch, in the same format
+        as /run. It waits for new batches while the job is running and returns once the job is finished.
+        For an attached job every batch is dropped once it is sent, and the batches still in the ring of the
+        worker are yielded as memoryviews of their slots, valid until the next chunk is requested. A reader that falls behind the kept
+        batches of a job gets ValueError before the first chunk, or a stream cut short after it.
+        """
+
+        index = max(0, from_batch)
+        with self.condition:
+            if index < job.first_batch:
+                raise ValueError(f"Batches before {job.first_batch} are not kept anymore")
+
+        if job.format == "json":
+            yield "[\n"
+
+        while True:
+            with self.condition:
+                while job.batch_count <= index and not job.is_finished():
+                    self.condition.wait()
+                if index < job.first_batch:
+                    return # the batches this reader needs were dropped while it was behind
+                chunks = job.batches[index - job.first_batch:]
+                finished = job.is_finished()
+
+            # the chunks are sent outside the lock, a slow client must not block the runner thread
+            for chunk in chunks:
+                length = len(chunk) # the JSON text is ASCII, so characters are bytes
+                if isinstance(chunk, SlotChunk):
+                    # sent as a memoryview of its slot, which is freed once the client has it (or went away)
+                    with self.condition:
+                        job.sending = chunk
+                    try:
+                        yield chunk.buffer()
+                    finally:
+                        with self.condition:
+                            job.sending = None
+                            chunk.release()
+                else:
+                    yield chunk
+                metrics.increment("bytes_streamed", length)
+                index += 1
+
+                if job.attached:
+                    with self.condition:
+                        del job.batches[0] # sent, so the batch is not needed anymore
+                        job.first_batch += 1
+                        self.condition.notify_all()
+
+            if finished and index >= job.batch_count:
+                break
+
+        if job.format == "json":
+            yield "]\n"
@@ -4,10 +4,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.signal import welch
 import time
-import json
 from kepco_lib import Kepco
 from sc5511a_lib import SC5511A
 from bnc_lib import SignalGenerator855B
+from data_format import DataWriter, HeaderLines, EXTENSION
+from disk_writer import DiskWriter
+from running_stats import RunningStats
+from stream_decoder import StreamDecoder, DecodeChunks, READ_SIZE
+from tcp_stream import StreamClient, StreamError
+
+# persistent TCP connection to the board, opened by the first run with transport = "tcp" and kept for the following runs
+stream_client = StreamClient("128.174.248.50", "magnetism@ESB165")
+
+# writer thread of the data files, the rows of every batch are written in the background while the next batch is received
+disk_writer = DiskWriter()
 
 def PlotReadout(read, time_row, filename, no_of_experiments, channel):
     
@@ -75,64 +85,98 @@ def CalculateSNR(signal):
 
     return snr, snr_dB
 
-def StartTXTFile(filename, timestamp, sample, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_current, LO_frequency,  LO_power, read_freq, note):
+def StartDataFile(filename, file_format, timestamp, sample, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_current, LO_frequency,  LO_power, read_freq, note):
     
     """
-    This function initiates .txt files with a headers containing metadata about the experiment.
+    This function initiates data files with a headers containing metadata about the experiment.
+    With file_format "txt" the metadata is written as "# ... #" lines of .txt files, with "binary"
+    the same metadata is the JSON header of .pgd files of data_format.py.
     """
     for index, signal_type in enumerate(["ch0_I", "ch0_Q", "ch1_I", "ch1_Q"]):
-        file = open("data/data_" + filename + f"_{signal_type}.txt", "w")
-        file.write(f"# Date and Time: {timestamp} #\n")
-        file.write(f"# Sample: {sample} #\n")
-        file.write(f"# Channel {signal_type[2]} {'In-phase' if signal_type[-1] == 'I' else 'Quadrature'} #\n")
-        file.write(f"# Pulse Type: {payload['type']} #\n")
-        file.write(f"# Pulse Frequency and Width: {payload['freq']} MHz, {payload['width'] * 4} ns #\n")
-        file.write(f"# Pulse Amplitude: {payload['amplitude']} a.u. #\n")
-        file.write(f"# Downconverting Frequency: {read_freq} MHz #\n")
+        metadata = {}  # the lines of the header in order, an entry without a value is written as it is
+        metadata["Date and Time"] = timestamp
+        metadata["Sample"] = sample
+        metadata[f"Channel {signal_type[2]} {'In-phase' if signal_type[-1] == 'I' else 'Quadrature'}"] = None
+        metadata["Pulse Type"] = payload['type']
+        metadata["Pulse Frequency and Width"] = f"{payload['freq']} MHz, {payload['width'] * 4} ns"
+        metadata["Pulse Amplitude"] = f"{payload['amplitude']} a.u."
+        metadata["Downconverting Frequency"] = f"{read_freq} MHz"
 
         if index in [0, 1]:  # only for channel 0 and 1
-            file.write(f"# LO Frequency and Power: {LO_frequency} GHz, {LO_power} dBm #\n")
-            file.write(f"# Magnet Current: {magnet_current} A #\n")
+            metadata["LO Frequency and Power"] = f"{LO_frequency} GHz, {LO_power} dBm"
+            metadata["Magnet Current"] = f"{magnet_current} A"
         else:
-            file.write("# Loopback channel, no LO and Magnet #\n")
+            metadata["Loopback channel, no LO and Magnet"] = None
 
-        file.write(f"# Number of Experiments: {number_of_experiments} #\n")
-        file.write(f"# Max Batch Size: {max_batch_size} #\n")
-        file.write(f"# Is each batch averaged?: {use_batch_average} #\n")
+        metadata["Number of Experiments"] = number_of_experiments
+        metadata["Max Batch Size"] = max_batch_size
+        metadata["Is each batch averaged?"] = use_batch_average
 
-        file.write(f"# Note: {note} #\n")
+        metadata["Note"] = note
 
         if use_batch_average:
-            file.write(f"# Data Format: Each row is a {max_batch_size}-experiment average #\n")
+            metadata["Data Format"] = f"Each row is a {max_batch_size}-experiment average"
         else:
-            file.write("# Data Format: Each row is an experiment #\n")
+            metadata["Data Format"] = "Each row is an experiment"
+
+        metadata["The second-to-last row is the average of all rows above"] = None
+        metadata["The last row is the time row in ns"] = None
 
-        file.write("# The second-to-last row is the average of all rows above #\n")
-        file.write("# The last row is the time row in ns #\n")
-        file.close()
+        if file_format == "txt":
+            file = open("data/data_" + filename + f"_{signal_type}.txt", "w")
+            file.writelines(HeaderLines(metadata))
+            file.close()
+        else:
+            DataWriter("data/data_" + filename + f"_{signal_type}" + EXTENSION, metadata, dtype = "<f4").close()
 
-def AppendToTXTFile(filename, data_type, data):
+def AppendToDataFile(filename, file_format, data_type, data, kind = "data"):
 
     """
-    This function appends a row of data to the .txt file.
-    It takes the filename, type of data (either 'array' or 'time'), and the data itself as input.
+    This function appends rows of data to the data files.
+    It takes the filename, the file format, type of data (either 'array' or 'time'), the data itself and,
+    for 'array', the kind of the rows ("data" or "average") as input.
     """
 
     if not isinstance(data, np.ndarray):
         raise TypeError("Input must be a numpy array")
+    if data_type not in ["array", "time"]:
+        raise ValueError("data_type must be 'array' or 'time'")
 
+    # the rows are written by the writer thread, the files stay open until disk_writer.finish()
     for index, signal_type in enumerate(["ch0_I", "ch0_Q", "ch1_I", "ch1_Q"]):
+        rows = data[index] if data_type == "array" else data
+        path = "data/data_" + filename + f"_{signal_type}" + (".txt" if file_format == "txt" else EXTENSION)
+        disk_writer.append(path, file_format, rows, "time" if data_type == "time" else kind, fmt = "%.6e")
 
-        if data_type == "array":
-            file = open("data/data_" + filename + f"_{signal_type}.txt", "a")
-            np.savetxt(file, data[index], fmt = "%.6e", delimiter = ",")
-            file.close()
-        elif data_type == "time":
-            file = open("data/data_" + filename + f"_{signal_type}.txt", "a")
-            np.savetxt(file, data, fmt = "%.6e", delimiter = ",")
-            file.close()
-        else:
-            raise ValueError("data_type must be 'array' or 'time'")
+def ReadBinaryBatches(frames):
+
+    """
+    This function takes the binary frames of the board, as (header, arrays) from stream_decoder.py or from
+    the TCP stream, and yields every batch as a dictionary, in the same layout as the batches of the JSON stream.
+    The arrays are views into the received buffers, no copies are made.
+    """
+
+    for header, arrays in frames:
+        if "mean" in arrays:
+            # the batch was reduced on the board, only its statistics are sent, indexed by (channel, I/Q, sample)
+            yield {
+                "batch_index": header["batch_index"],
+                "count": header["count"],
+                "mean": arrays["mean"],
+                "variance": arrays["variance"],
+                "time_row": arrays.get("time_row")
+            }
+            continue
+
+        iq = arrays["iq"]  # indexed by (shot, channel, I/Q, sample)
+        yield {
+            "batch_index": header["batch_index"],
+            "ch0_I": iq[:, 0, 0],
+            "ch0_Q": iq[:, 0, 1],
+            "ch1_I": iq[:, 1, 0],
+            "ch1_Q": iq[:, 1, 1],
+            "time_row": arrays.get("time_row")
+        }
 
 def InitializeMagnet(GPIB_channel = 1):
 
@@ -314,19 +358,30 @@ def GetLOStatus(instance):
 
 def main(timestamp, sample, pulse_type = "gaussian", pulse_frequency = 120, pulse_width = 15, pulse_amplitude = 30000, 
          read_frequency = 0, magnet_inst = None, magnet_current = 0.0, LO_inst = None, LO_frequency = 5.0, LO_power = 0.0, 
-         number_of_experiments = 1000, max_batch_size = 1000, use_batch_average = True,  note = ""):
+         number_of_experiments = 1000, max_batch_size = 1000, use_batch_average = True,  note = "", stream_format = "binary", transport = "http",
+         file_format = "binary"):
 
     """
     This main function sends a request to the Flask (a type of web server)
     server running on the board itself. Some parameters of the pulse is passed 
     with the request, and the readouts from ADCs are returned in JSON format 
-    from the board. This function then exports the data to a .txt file, detects
+    from the board. This function then exports the data to a data file, detects
     the pulses present, and plots the data.
     """
 
-    # raise an error if the max_batch_size is greater than 3000 to avoid memory issues on the board
-    if max_batch_size > 3000:
-        raise ValueError("max_batch_size cannot be greater than 3000 due to memory limitations of the board")
+    # raise an error if the max_batch_size is too large for the memory of the board, JSON text needs much more memory than binary frames
+    max_allowed_batch_size = 10000 if stream_format == "binary" else 3000
+    if max_batch_size > max_allowed_batch_size:
+        raise ValueError(f"max_batch_size cannot be greater than {max_allowed_batch_size} due to memory limitations of the board")
+
+    # raise an error if the transport is unknown, the TCP stream of the board only carries binary frames
+    if transport not in ["http", "tcp"]:
+        raise ValueError("Only supported transports are 'http' and 'tcp'")
+    if transport == "tcp" and stream_format != "binary":
+        raise ValueError("The TCP stream only supports the binary format")
+
+    if file_format not in ["binary", "txt"]:
+        raise ValueError("Only supported file formats are 'binary' (.pgd) and 'txt'")
     
     if pulse_amplitude < 0 or pulse_amplitude > 32768:
         raise ValueError("Pulse amplitude must be between 0 and 32768")
@@ -366,20 +421,20 @@ def main(timestamp, sample, pulse_type = "gaussian", pulse_frequency = 120, puls
                                                             # trigger_delay = 1 -> first pulse around t = 50ns
         'number_of_expt': number_of_experiments,            # how many experiments to be done
         'max_batch_size': max_batch_size,                   # maximum number of experiments in one batch (in one go)
-        'read_freq': read_frequency                         # frequency to downconvert the signal
+        'read_freq': read_frequency,                        # frequency to downconvert the signal
+        'format': stream_format,                            # format of the stream, "binary" frames or "json" text
+        'reduce': use_batch_average                         # if True, the board sends only the mean and variance of each batch
     }
 
     fs = 552.96e6 # define decimated sampling frequency of the ADCs
 
-    all_batches_data_ch0_I = []  # list to store the data for channel 0 I
-    all_batches_data_ch0_Q = []  # list to store the data for channel 0 Q
-    all_batches_data_ch1_I = []  # list to store the data for channel 1 I
-    all_batches_data_ch1_Q = []  # list to store the data for channel 1 Q
+    # running mean, variance, min and max of every channel and quadrature, the shots are not kept
+    quadrature_stats = {name: RunningStats(extrema = True) for name in ["ch0_I", "ch0_Q", "ch1_I", "ch1_Q"]}
 
     filename = f"decimated_{timestamp}_Sample={sample}_Pulse={pulse_type}_{payload['freq']}MHz_AvgN={number_of_experiments}_MagnetI={magnet_current}_A"
     
-    # export the data to a .txt file
-    StartTXTFile(filename, timestamp, sample, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_current, LO_frequency, LO_power, read_frequency, note)
+    # export the data to a data file
+    StartDataFile(filename, file_format, timestamp, sample, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_current, LO_frequency, LO_power, read_frequency, note)
 
     # check the status of the LO device, if it is too hot, wait for it to cool down
     (LO_temp, LO_rf_params, LO_status) =  GetLOStatus(LO_inst)
@@ -425,114 +480,140 @@ def main(timestamp, sample, pulse_type = "gaussian", pulse_frequency = 120, puls
 
     print("Sending experiments...")
 
-    # send the actual request (HTTP request) to the board. don't forget to add the password. get the response from the board 
-    response = requests.post(url, json=payload, headers={"auth": "magnetism@ESB165"}, stream=True)
-
-    # if the response is not OK, raise an error
-    if response.status_code != 200:
-        print(f"Request failed with status code {response.status_code}")
-        print("Response body:", response.text)
-        raise RuntimeError("Failed request")
+    if transport == "tcp":
+        # send the request over the persistent TCP connection, which is reused by the next runs
+        while True:
+            try:
+                frames = stream_client.run(payload)
+                break
+            except StreamError as e:
+                # the board runs one experiment at a time, if its queue is full wait as long as it asks and try again
+                if e.retry_after is None:
+                    raise RuntimeError(f"Failed request: {e}")
+                retry_after = max(1, int(e.retry_after))
+                print(f"Board is busy, trying again in {retry_after} s...")
+                time.sleep(retry_after)
+    else:
+        # send the actual request (HTTP request) to the board. don't forget to add the password. get the response from the board 
+        response = requests.post(url, json=payload, headers={"auth": "magnetism@ESB165"}, stream=True)
+
+        # the board runs one experiment at a time, if its queue is full wait as long as it asks and try again
+        while response.status_code == 429:
+            retry_after = int(response.headers.get("Retry-After", 10))
+            print(f"Board is busy, trying again in {retry_after} s...")
+            time.sleep(retry_after)
+            response = requests.post(url, json=payload, headers={"auth": "magnetism@ESB165"}, stream=True)
+
+        # if the response is not OK, raise an error
+        if response.status_code != 200:
+            print(f"Request failed with status code {response.status_code}")
+            print("Response body:", response.text)
+            raise RuntimeError("Failed request")
     
-    buffer = ""
     expected_batch_index = 0
     total_batches = (number_of_experiments + max_batch_size - 1) // max_batch_size  # calculate the total number of batches
     print(f"Waiting for batch {expected_batch_index + 1}...")
-    
-    for line in response.iter_lines(decode_unicode=True):
-        buffer += line
-        if line.strip().endswith("}"):
-            try:
-                if buffer[0] == "[":
-                    buffer = buffer[1:]
-                batch = json.loads(buffer)
-                buffer = ""  # reset the buffer after successful parsing
-
-                # check if the batch is the expected one
-                index = batch.get("batch_index")
-                if index is None:
-                    raise ValueError("Batch index is missing in the response")
-                if index != expected_batch_index:
-                    raise ValueError(f"Unexpected batch index: {index}, expected: {expected_batch_index}")
-                expected_batch_index += 1
-
-                # extract the data from the batch
-                ch0_I = np.array(batch["ch0_I"])
-                ch0_Q = np.array(batch["ch0_Q"])
-                ch1_I = np.array(batch["ch1_I"])
-                ch1_Q = np.array(batch["ch1_Q"])
-
-                # check if the data is in the expected format
-                is_last_batch = (index == total_batches - 1)
-                if is_last_batch and (number_of_experiments % max_batch_size != 0):
-                    expected_length = number_of_experiments % max_batch_size
-                else:
-                    expected_length = max_batch_size
-
-                if ch0_I.shape[0] != expected_length or ch0_Q.shape[0] != expected_length or ch1_I.shape[0] != expected_length or ch1_Q.shape[0] != expected_length:
-                    raise ValueError(f"Batch {index} has unexpected length: ch0_I: {ch0_I.shape[0]}, ch0_Q: {ch0_Q.shape[0]}, ch1_I: {ch1_I.shape[0]}, ch1_Q: {ch1_Q.shape[0]}. Expected length: {expected_length}")
-
-                if batch.get("time_row") is not None:
-                    time_row = np.array(batch["time_row"]) * 1e3 # convert time row to ns
-                
-                print(f"Batch {expected_batch_index} acquired successfully.")
-
-                if use_batch_average:
-                    # if we are using batch averaging, we take the average of the data part
-                    avg_data_ch0_I = np.mean(ch0_I, axis=0)
-                    avg_data_ch0_Q = np.mean(ch0_Q, axis=0)
-                    avg_data_ch1_I = np.mean(ch1_I, axis=0)
-                    avg_data_ch1_Q = np.mean(ch1_Q, axis=0)
-
-                    all_batches_data_ch0_I.append(avg_data_ch0_I[np.newaxis, :])
-                    all_batches_data_ch0_Q.append(avg_data_ch0_Q[np.newaxis, :])
-                    all_batches_data_ch1_I.append(avg_data_ch1_I[np.newaxis, :])
-                    all_batches_data_ch1_Q.append(avg_data_ch1_Q[np.newaxis, :])
-
-                    AppendToTXTFile(filename, data_type = "array", data = np.array([avg_data_ch0_I[np.newaxis, :], avg_data_ch0_Q[np.newaxis, :], avg_data_ch1_I[np.newaxis, :], avg_data_ch1_Q[np.newaxis, :]]))
-                else:
-                    # if we are not using batch averaging, we append the whole data part to the all_batches_data
-                    all_batches_data_ch0_I.extend(ch0_I)
-                    all_batches_data_ch0_Q.extend(ch0_Q)
-                    all_batches_data_ch1_I.extend(ch1_I)
-                    all_batches_data_ch1_Q.extend(ch1_Q)
-
-                    AppendToTXTFile(filename, data_type = "array", data = np.array([ch0_I, ch0_Q, ch1_I, ch1_Q]))
-
-                print(f"Batch {expected_batch_index} processed successfully")
-                
-                if not is_last_batch:
-                    print(f"Waiting for batch {expected_batch_index + 1}...")
-
-            except json.JSONDecodeError:
-                print(f"Error decoding JSON for batch {expected_batch_index}")
-                continue
-
-            except Exception as e:
-                print(f"Error processing batch {expected_batch_index}: {e}")
-                break
 
-    all_batches_data_ch0_I = np.array(all_batches_data_ch0_I)
-    all_batches_data_ch0_Q = np.array(all_batches_data_ch0_Q)
-    all_batches_data_ch1_I = np.array(all_batches_data_ch1_I)
-    all_batches_data_ch1_Q = np.array(all_batches_data_ch1_Q)
-
-    # calculate the grand average of all batches
-    if use_batch_average:
-        grand_average_ch0_I = np.mean(all_batches_data_ch0_I, axis=0)[0]
-        grand_average_ch0_Q = np.mean(all_batches_data_ch0_Q, axis=0)[0]
-        grand_average_ch1_I = np.mean(all_batches_data_ch1_I, axis=0)[0]
-        grand_average_ch1_Q = np.mean(all_batches_data_ch1_Q, axis=0)[0]
+    # read the stream batch by batch, every batch is decoded once as soon as it is complete and binary frames
+    # are decoded without copies (see stream_decoder.py)
+    if transport == "tcp":
+        decoder = stream_client.decoder
+        batches = ReadBinaryBatches(frames)
     else:
-        grand_average_ch0_I = np.mean(all_batches_data_ch0_I, axis=0)
-        grand_average_ch0_Q = np.mean(all_batches_data_ch0_Q, axis=0)
-        grand_average_ch1_I = np.mean(all_batches_data_ch1_I, axis=0)
-        grand_average_ch1_Q = np.mean(all_batches_data_ch1_Q, axis=0)
+        decoder = StreamDecoder(stream_format)
+        frames = DecodeChunks(response.iter_content(chunk_size=READ_SIZE), decoder)
+        batches = ReadBinaryBatches(frames) if stream_format == "binary" else frames
+    
+    for batch in batches:
+        # check if the batch is the expected one
+        index = batch.get("batch_index")
+        if index is None:
+            raise ValueError("Batch index is missing in the response")
+        if index != expected_batch_index:
+            raise ValueError(f"Unexpected batch index: {index}, expected: {expected_batch_index}")
+        expected_batch_index += 1
+
+        # extract the data from the batch, without copying the decoded arrays
+        if use_batch_average:
+            # the board already reduced the batch, indexed by (channel, I/Q, sample)
+            batch_mean = np.asarray(batch["mean"])
+            batch_variance = np.asarray(batch["variance"])
+            batch_count = batch["count"]
+        else:
+            ch0_I = np.asarray(batch["ch0_I"])
+            ch0_Q = np.asarray(batch["ch0_Q"])
+            ch1_I = np.asarray(batch["ch1_I"])
+            ch1_Q = np.asarray(batch["ch1_Q"])
+
+        # check if the data is in the expected format
+        is_last_batch = (index == total_batches - 1)
+        if is_last_batch and (number_of_experiments % max_batch_size != 0):
+            expected_length = number_of_experiments % max_batch_size
+        else:
+            expected_length = max_batch_size
 
-    # append the final average data and the time row to the .txt file
-    AppendToTXTFile(filename, data_type = "array", data = np.array([grand_average_ch0_I[np.newaxis, :], grand_average_ch0_Q[np.newaxis, :],
-                                        grand_average_ch1_I[np.newaxis, :], grand_average_ch1_Q[np.newaxis, :]]))
-    AppendToTXTFile(filename, data_type = "time", data = time_row[np.newaxis, :])
+        if use_batch_average:
+            if batch_count != expected_length:
+                raise ValueError(f"Batch {index} has unexpected length: {batch_count}. Expected length: {expected_length}")
+        elif ch0_I.shape[0] != expected_length or ch0_Q.shape[0] != expected_length or ch1_I.shape[0] != expected_length or ch1_Q.shape[0] != expected_length:
+            raise ValueError(f"Batch {index} has unexpected length: ch0_I: {ch0_I.shape[0]}, ch0_Q: {ch0_Q.shape[0]}, ch1_I: {ch1_I.shape[0]}, ch1_Q: {ch1_Q.shape[0]}. Expected length: {expected_length}")
+
+        if batch.get("time_row") is not None:
+            time_row = np.array(batch["time_row"]) * 1e3 # convert time row to ns
+        
+        print(f"Batch {expected_batch_index} acquired successfully.")
+
+        if use_batch_average:
+            # if we are using batch averaging, the board already sent the average of the batch
+            avg_data_ch0_I = batch_mean[0, 0]
+            avg_data_ch0_Q = batch_mean[0, 1]
+            avg_data_ch1_I = batch_mean[1, 0]
+            avg_data_ch1_Q = batch_mean[1, 1]
+
+            quadrature_stats["ch0_I"].merge(batch_count, avg_data_ch0_I, batch_variance[0, 0])
+            quadrature_stats["ch0_Q"].merge(batch_count, avg_data_ch0_Q, batch_variance[0, 1])
+            quadrature_stats["ch1_I"].merge(batch_count, avg_data_ch1_I, batch_variance[1, 0])
+            quadrature_stats["ch1_Q"].merge(batch_count, avg_data_ch1_Q, batch_variance[1, 1])
+
+            AppendToDataFile(filename, file_format, data_type = "array", data = np.array([avg_data_ch0_I[np.newaxis, :], avg_data_ch0_Q[np.newaxis, :], avg_data_ch1_I[np.newaxis, :], avg_data_ch1_Q[np.newaxis, :]]))
+        else:
+            # if we are not using batch averaging, the shots are added to the running statistics
+            quadrature_stats["ch0_I"].update(ch0_I)
+            quadrature_stats["ch0_Q"].update(ch0_Q)
+            quadrature_stats["ch1_I"].update(ch1_I)
+            quadrature_stats["ch1_Q"].update(ch1_Q)
+
+            AppendToDataFile(filename, file_format, data_type = "array", data = np.array([ch0_I, ch0_Q, ch1_I, ch1_Q]))
+
+        print(f"Batch {expected_batch_index} processed successfully, {disk_writer.depth()} writes waiting for the disk")
+        
+        if not is_last_batch:
+            print(f"Waiting for batch {expected_batch_index + 1}...")
+
+    if expected_batch_index != total_batches:
+        raise RuntimeError(f"Stream ended after {expected_batch_index} batches, expected {total_batches}")
+
+    # time spent decoding the stream on this computer
+    decode_stats = decoder.stats()
+    print(f"Decoded {decode_stats['frames']} frames ({decode_stats['bytes'] / 1e6:.1f} MB) in {decode_stats['decode_seconds'] * 1e3:.1f} ms, at most {decode_stats['max_decode_seconds'] * 1e3:.2f} ms per frame")
+
+    # the grand average of all batches, weighted by the number of experiments in each batch
+    grand_average_ch0_I = quadrature_stats["ch0_I"].mean
+    grand_average_ch0_Q = quadrature_stats["ch0_Q"].mean
+    grand_average_ch1_I = quadrature_stats["ch1_I"].mean
+    grand_average_ch1_Q = quadrature_stats["ch1_Q"].mean
+
+    for name, stats in quadrature_stats.items():
+        print(f"{name}: {stats.count} experiments, mean standard deviation of a sample: {np.mean(np.sqrt(stats.variance())):.3f}")
+
+    # append the final average data and the time row to the data file
+    AppendToDataFile(filename, file_format, data_type = "array", data = np.array([grand_average_ch0_I[np.newaxis, :], grand_average_ch0_Q[np.newaxis, :],
+                                                                                  grand_average_ch1_I[np.newaxis, :], grand_average_ch1_Q[np.newaxis, :]]), kind = "average")
+    AppendToDataFile(filename, file_format, data_type = "time", data = time_row[np.newaxis, :])
+
+    # wait for the writer thread, the data files are complete and closed after this
+    write_stats = disk_writer.finish()
+    print(f"Wrote {write_stats['bytes'] / 1e6:.1f} MB in {write_stats['write_seconds'] * 1e3:.1f} ms, the stream waited {write_stats['wait_seconds'] * 1e3:.1f} ms for the disk, at most {write_stats['max_depth']} of {disk_writer.capacity} writes queued")
 
     # plot the final readout and PSD of the averaged data
     PlotReadout(np.abs(grand_average_ch0_I + 1j * grand_average_ch0_Q), time_row, filename, number_of_experiments, channel = 0)
@@ -583,13 +664,19 @@ if __name__ == "__main__":
             number_of_experiments = 10000,                                # total number of experiments
             max_batch_size = 1000,                                      # maximum number of experiments in one batch (in one go)
             use_batch_average = False,                                  # whether to average batches of experiments or not
-            note = "test"                              # notes for the experiment, labeling purposes
+            note = "test",                             # notes for the experiment, labeling purposes
+            stream_format = "binary",                                   # format of the data stream, "binary" frames or "json" text
+            transport = "tcp",                                          # "tcp" for the persistent stream connection of the board, "http" for /run
+            file_format = "binary"                                      # format of the data files, "binary" .pgd files (see data_format.py) or "txt"
         )
     finally:
         RampMagnetCurrent(magnet_instance, 0.0)  # double check that the magnet is turned off
 
         TurnOffLO(LO_instance)  # double check that the local oscillator is turned off
 
+        stream_client.close() # close the TCP connection to the board, if it was opened
+        disk_writer.close() # write what is still queued and close the data files
+
         if isinstance(LO_instance, SC5511A):
             LO_instance.close_device() # close the connection to the SC5511A device, this is needed since it is NOT a VISA device
             print("LO connection closed")
@@ -2,15 +2,22 @@
 
 import sys
 import json
+import time
+from functools import lru_cache
 
-from qick import * # type: ignore
-from drivers.RBSupport import generate_2qgateset # type: ignore
+from qick import QickSoc, AveragerProgram # type: ignore
+from drivers.RBSupport import generate_2qgateset, waveform_aliases # type: ignore
+from program_cache import program_cache
+from metrics import metrics
+from running_stats import RunningStats
+from wire_format import CompactArray, EncodeFrame
+from sweep import SweepPoints
+from pipeline import Pipelined, RING_BUFFERS
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-soc = QickSoc() # type: ignore
-soccfg = soc
+# page 0 register counting the pulses of a train, AveragerProgram uses registers 14 and 15 of page 0 for its own loop
+TRAIN_REGISTER = 13
 
 class PulseSequence(AveragerProgram): # type: ignore
     def initialize_phases(self):
@@ -19,57 +26,75 @@ class PulseSequence(AveragerProgram): # type: ignore
         self.phase_ref_q2 = 0
         self.phase_ref_c = 0
     
+    def set_gate_registers(self, q, name):
+        # set the pulse registers of the channel of qubit q ("Q1" or "Q2") for the given gate, returns the channel
+        if q == "Q1": # Qubit 1
+            ch, freq, phase_ref = self.cfg["q1_ch"], self.freq_q1, self.phase_ref_q1
+        else:
+            ch, freq, phase_ref = self.cfg["q2_ch"], self.freq_q2, self.phase_ref_q2
+
+        ginfo = self.cfg["gate_set"][name]
+        phase = self.deg2reg(phase_ref + ginfo["phase"], gen_ch=ch)
+
+        if self.cfg["pulse_style"] == "flat_top":
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     waveform=self.waveforms[name], phrst = 1,
+                                     length = self.cfg["length"])
+        elif self.cfg["pulse_style"] == "const":
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     phrst = 1, mode="oneshot",
+                                     length = self.cfg["length"])
+        else:
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     waveform=self.waveforms[name], phrst = 1, mode="oneshot")
+        return ch
+
+    def gate_cycles(self, q, name):
+        # length of the gate in tProcessor cycles, the envelope has samps_per_clk samples per generator cycle
+        ch = self.cfg["q1_ch"] if q == "Q1" else self.cfg["q2_ch"]
+
+        if self.cfg["pulse_style"] == "const":
+            gen_cycles = self.cfg["length"]
+        else:
+            gen_cycles = len(self.cfg["gate_set"][name]["idata"]) // self.soccfg["gens"][ch]["samps_per_clk"]
+            if self.cfg["pulse_style"] == "flat_top":
+                gen_cycles += self.cfg["length"] # the flat part sits between the two halves of the envelope
+
+        return self.us2cycles(self.cycles2us(gen_cycles, gen_ch=ch))
+
     def play_seq(self, seq):
         for g in seq:
             for q in g:
-                if q == "Q2":
-                    ginfo=self.cfg["gate_set"][g[q]]
-
-                    if self.cfg["pulse_style"] == "flat_top":
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 1,
-                                                    length = self.cfg["length"])
-                    elif self.cfg["pulse_style"] == "const":
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    phrst = 1, mode="oneshot",
-                                                    length = self.cfg["length"])
-                    else:
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 1, mode="oneshot")
-                    self.pulse(ch=self.cfg["q2_ch"])
-
-                if q == "Q1": # Qubit 1
-                    ginfo=self.cfg["gate_set"][g[q]]
-
-                    if self.cfg["pulse_style"] == "flat_top":
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                    phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 1,
-                                                    length = self.cfg["length"])
-                    elif self.cfg["pulse_style"] == "const":
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                    phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                    phrst = 1, mode="oneshot",
-                                                    length = self.cfg["length"])
-                    else:
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                 phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                 gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                 waveform=g[q], phrst = 1, mode="oneshot")
-
-                    self.pulse(ch=self.cfg["q1_ch"])
+                ch = self.set_gate_registers(q, g[q])
+                self.pulse(ch=ch)
             ################
            #modified sync_all with only DAC clocks, no ADC clocks
             self.synci(self.us2cycles(0.01))
-    
+
+    def play_train(self, seq, count):
+        # play seq count times back to back. instead of unrolling the train, the tProcessor loops over it, so
+        # the program size and the compile time do not depend on count. every pulse starts at t=0 and
+        # the reference time is moved forward by the gate length, which keeps the pulses back to back.
+        if count < 1:
+            return
+        if count == 1:
+            self.play_seq(seq)
+            return
+
+        # with a single gate the registers keep their values during the whole train, so they are set only once
+        channels = {q: self.set_gate_registers(q, seq[0][q]) for q in seq[0]} if len(seq) == 1 else None
+
+        self.regwi(0, TRAIN_REGISTER, count - 1)
+        self.label("PULSE_TRAIN")
+
+        for g in seq:
+            for q in g:
+                ch = channels[q] if channels is not None else self.set_gate_registers(q, g[q])
+                self.pulse(ch=ch, t=0)
+            self.synci(max(self.gate_cycles(q, g[q]) for q in g))
+
+        self.loopnz(0, TRAIN_REGISTER, "PULSE_TRAIN") # repeats until the counter runs out
+
     def initialize(self):
         cfg = self.cfg
         self.gate_seq = cfg['gate_seq']
@@ -87,7 +112,10 @@ class PulseSequence(AveragerProgram): # type: ignore
         self.freq_q1 = self.freq2reg(cfg["q1_pulse_freq"], gen_ch=cfg["q1_ch"], ro_ch=cfg["q1_ro_ch"])
         self.freq_q2 = self.freq2reg(cfg["q2_pulse_freq"], gen_ch=cfg["q2_ch"], ro_ch=cfg["q2_ro_ch"])
 
-        for name, ginfo in self.gate_set.items():
+        # upload only the gates that are played, and gates with identical I/Q data only once
+        self.waveforms = waveform_aliases(self.gate_set, self.gate_seq)
+        for name in dict.fromkeys(self.waveforms.values()):
+            ginfo = self.gate_set[name]
             self.add_pulse(ch=cfg["q1_ch"], name=name,
                            idata=ginfo["idata"],
                            qdata=ginfo["qdata"],
@@ -121,11 +149,20 @@ class PulseSequence(AveragerProgram): # type: ignore
                      adc_trig_offset=self.cfg["adc_trig_offset"])
 
         self.initialize_phases()
-        self.play_seq(self.gate_seq)
+        self.play_train(self.gate_seq, self.cfg.get("pulse_count", 1))
         self.wait_all()
         self.sync_all(self.us2cycles(self.cfg["relax_delay"]))
 
-def GeneratePulse(pulse_type = "gaussian", freq = 1000, width = 10, amplitude = 30000, pulse_count = 1, trig_delay = 1, no_of_expt = 1, channel = 0):
+def GeneratePulse(soc, pulse_type = "gaussian", freq = 1000, width = 10, amplitude = 30000, pulse_count = 1, trig_delay = 1, no_of_expt = 1, channel = 0, out = None, size = None):
+
+    """
+    This function runs no_of_expt experiments and returns the readouts, indexed by (experiment, sample).
+    channel can also be a list of ADC channels, then the readouts are indexed by (experiment, channel, sample).
+    If out is given, the readouts are written into it instead of a new array, so a buffer can be reused. Otherwise
+    a new array of size experiments (no_of_expt if None) is allocated, of which the first no_of_expt are returned.
+    """
+
+
     # transfer the input parameters to local variables
     q1_pulse_freq = freq 
     q1_read_freq = freq
@@ -164,32 +201,141 @@ def GeneratePulse(pulse_type = "gaussian", freq = 1000, width = 10, amplitude =
     elif pulse_type == "const":
         config["pulse_style"] = "const"
       
-    config["gate_set"] = generate_2qgateset(config)
-    
     # get the desired sequence of gates (pi pulses). for now, only X gates are applied.
-    config['gate_seq'] = [{'Q1': 'X', 'Q2': 'X'}] * pulse_count
+    # the sequence is repeated pulse_count times by a loop in the tProcessor
+    config['gate_seq'] = [{'Q1': 'X', 'Q2': 'X'}]
+    config['pulse_count'] = pulse_count
 
-    prog = PulseSequence(soccfg, config) # initiate the pulse program which does everything
+    # reuse the compiled program if the same pulse configuration was run before
+    prog = program_cache.get(PulseSequence, config)
+    if prog is None:
+        with metrics.stage("compile"):
+            config["gate_set"] = generate_2qgateset(config)
+            prog = PulseSequence(soc, config) # initiate the pulse program which does everything
+        program_cache.put(PulseSequence, config, prog)
     
-    readout = []
+    readout = out
+
+    # the MR buffer holds a single capture, so every experiment is still one program execution. the pulses
+    # are all oneshot, so clearing the generators once is enough and the waveforms are uploaded only once
+    soc.reset_gens() # clear out any DC or periodic values from the generator channels
+
+    # the program, the generator and readout settings and the waveforms are loaded once for the whole batch,
+    # every experiment only arms the MR buffer and runs the loaded program again
+    prog.config_all(soc, load_pulses=program_cache.needs_upload(prog)) # waveforms only if they are not there already
+    program_cache.mark_loaded(prog)
+
+    # the MR buffer is connected to one ADC at a time, so with several channels every experiment is played
+    # once per channel, right after each other. this way the channels of an experiment see the same conditions
+    channels = channel if isinstance(channel, list) else [channel]
     
-    for _ in range(no_of_expt):
-        soc.reset_gens() # clear out any DC or periodic values from the generator channels
+    acquire_start = time.perf_counter()
 
-        soc.arm_mr(ch = channel) # arm (get ready) the MR buffer
+    for k in range(no_of_expt):
+        for c, ch in enumerate(channels):
+            soc.arm_mr(ch = ch) # arm (get ready) the MR buffer
 
-        prog.config_all(soc) # send the config to the FPGA
+            soc.tproc.stop() # stop the tProcessor after the previous experiment, so start() runs the loaded program again from the beginning
+            soc.tproc.start() # start the main process, which runs everything
 
-        soc.tproc.start() # start the main process, which runs everything
+            mr = soc.get_mr() # read from the MR buffer
 
-        readout.append(soc.get_mr()) # read from the MR buffer
-    
-    return np.array(readout)
+            if readout is None:
+                rows = max(no_of_expt, size or 0)
+                shape = (rows, len(channels), len(mr)) if isinstance(channel, list) else (rows, len(mr))
+                readout = np.empty(shape, dtype=mr.dtype)
+            target = readout[k, c] if isinstance(channel, list) else readout[k]
+            target[:] = mr[:, 0]
 
-def main():
+    metrics.observe("acquire", time.perf_counter() - acquire_start)
     
-    # get the data from the server.py call
-    data = json.load(sys.stdin)
+    return readout[:no_of_expt]
+
+@lru_cache(maxsize=8)
+def AntiAliasTaps(decimation):
+
+    """
+    This function returns the coefficients of the low-pass FIR filter used before decimating by the
+    given factor, with the cutoff at the new Nyquist frequency (the same design as scipy.signal.decimate).
+    """
+
+    from scipy.signal import firwin # imported here since most requests do not decimate, and scipy is slow to import on the board
+
+    return firwin(20 * decimation + 1, 1.0 / decimation, window="hamming")
+
+def CropAndDecimate(shots, time_row, window_start, window_stop, decimation):
+
+    """
+    This function keeps only the samples between window_start and window_stop (in ns, None for no limit),
+    then decimates them by the integer factor decimation with an anti-alias FIR filter. It takes the shots
+    indexed by (experiment, sample) or (experiment, channel, sample) with their time row in us, and returns
+    the new shots and time row.
+    """
+
+    times = time_row * 1e3 # in ns
+    start = 0 if window_start is None else int(np.searchsorted(times, window_start))
+    stop = len(times) if window_stop is None else int(np.searchsorted(times, window_stop))
+
+    if decimation <= 1:
+        return shots[..., start:stop], time_row[start:stop] # views, nothing is copied
+
+    from scipy.signal import resample_poly
+
+    taps = AntiAliasTaps(decimation)
+
+    # filter a margin around the window as well, so the samples at its edges are filtered with real data instead of zero padding
+    margin = (len(taps) // 2 // decimation + 1) * decimation
+    low = max(0, start - margin)
+    high = min(len(times), stop + margin)
+    filtered = resample_poly(shots[..., low:high].astype(np.float32), 1, decimation, axis=-1, window=taps)
+
+    # sample k of the output is at sample low + k * decimation of the input, keep the ones inside the window
+    first = -(-(start - low) // decimation)
+    last = -(-(stop - low) // decimation)
+
+    return filtered[..., first:last], time_row[low::decimation][first:last]
+
+def EncodeBatch(header, shots, time_row, stream_format, reduce):
+
+    """
+    This function encodes one batch of shots, indexed by (experiment, sample) or (experiment, channel, sample),
+    as a binary frame or as a JSON line. If reduce is True, only the mean, variance and count of the batch are encoded.
+    The time row is included if it is not None.
+    """
+
+    if reduce:
+        # only the statistics of the batch are sent, not the shots
+        stats = RunningStats()
+        stats.update(shots)
+
+        if stream_format == "binary":
+            arrays = {"mean": stats.mean.astype("<f4"), "variance": stats.variance().astype("<f4")}
+            if time_row is not None:
+                arrays["time_row"] = time_row
+            return EncodeFrame(dict(header, count=stats.count), arrays)
+
+        batch_result = dict(header, count=stats.count, mean=stats.mean.tolist(), variance=stats.variance().tolist())
+    else:
+        if stream_format == "binary":
+            arrays = {"shots": CompactArray(shots)}
+            if time_row is not None:
+                arrays["time_row"] = time_row
+            return EncodeFrame(header, arrays)
+
+        batch_result = dict(header, shots=shots.tolist())
+
+    batch_result["time_row"] = time_row.tolist() if time_row is not None else None
+    return json.dumps(batch_result) + "\n"
+
+def RunExperiment(soc, data, emit):
+
+    """
+    This function runs one request on an already initialized QickSoc. It takes the soc, the
+    request parameters (same as the JSON sent to server.py) and an emit function that is called
+    with every chunk of the output stream (text lines or binary frames). This way the same code runs as a script and inside the persistent worker.
+    """
+
+    # get the parameters of the request
     pulse_type = data.get("type")
     pulse_frequency = data.get("freq")
     pulse_width = data.get("width") # in ns
@@ -197,9 +343,20 @@ def main():
     pulse_count = data.get("pulse_count")
     trigger_delay = data.get("trigger_delay")
     number_of_expt = data.get("number_of_expt")
-    channel = data.get("channel")
+    channel = data.get("channel") # 0 (ADC_D), 1 (ADC_C) or "both"
+    max_batch_size = data.get("max_batch_size", 1000) # default is 1000
+    stream_format = data.get("format", "json") # "json" for text lines, "binary" for wire_format frames
+    reduce = bool(data.get("reduce", False)) # if True, only the mean, variance and count of each batch are sent
+    sweep = data.get("sweep") # optional sweep of freq or gain, number_of_expt experiments per point (see sweep.py)
+    window_start = data.get("window_start") # start of the readout window in ns, None to start from the first sample
+    window_stop = data.get("window_stop") # end of the readout window in ns, None to go until the last sample
+    decimation = int(data.get("decimation", 1)) # integer decimation factor of the readout, with an anti-alias filter
     
     # safety checks for the input parameters
+    if stream_format not in ["json", "binary"]:
+        stream_format = "json"
+    if max_batch_size <= 0 or max_batch_size > (10000 if stream_format == "binary" else 1000): # JSON text needs much more memory than the shot buffer
+        max_batch_size = 1000
     if pulse_type not in ["gaussian", "flat_top", "const"]:
         pulse_type = "gaussian"
     if pulse_frequency < 0 or pulse_frequency > 9800:
@@ -208,22 +365,95 @@ def main():
         pulse_amplitude = 30000
     if pulse_width < 0 or pulse_width > 50:
         pulse_width = 10
+    if decimation < 1 or decimation > 64:
+        raise ValueError("decimation must be between 1 and 64")
+    if window_start is not None and window_stop is not None and window_start >= window_stop:
+        raise ValueError("window_start must be before window_stop")
+    if channel not in [0, 1, "both"]:
+        raise ValueError("channel must be 0, 1 or \"both\"")
+
+    # with "both", every experiment is captured on both ADCs and the shots get a channel axis
+    channel_header = {}
+    if channel == "both":
+        channel = [0, 1]
+        channel_header = {"channels": channel}
+
+    # the points of the sweep, if any, or a single point with the parameters of the request. the MR buffer holds
+    # a single shot, so every shot is a program execution anyway and the sweep simply runs point by point,
+    # with the compiled program of every point reused from the program cache when the sweep is repeated
+    if sweep:
+        points = [(value, {"sweep_index": index, "sweep_value": float(value)}) for index, value in enumerate(SweepPoints(sweep))]
+    else:
+        points = [(None, {})]
+
+    def acquire_batches():
+        # yields (sweep_header, shots) for every batch. the readout buffers, indexed by (experiment, sample), are
+        # allocated once and reused in turn, so the shots are valid until RING_BUFFERS more batches are acquired.
+        # every buffer holds a full batch, since a short last batch (e.g. of a sweep point) can come first
+        buffers = [None] * RING_BUFFERS
+        batch = 0
 
-    readout = GeneratePulse(pulse_type, pulse_frequency, pulse_width, pulse_amplitude, pulse_count, trigger_delay, number_of_expt, channel) # execute the main function
+        for value, sweep_header in points:
+            # the swept parameter replaces the frequency or the amplitude of the request
+            frequency = float(value) if sweep and sweep["parameter"] == "freq" else pulse_frequency
+            amplitude = int(value) if sweep and sweep["parameter"] == "gain" else pulse_amplitude
 
-    time_row = (soc.cycles2us(np.arange(0, len(readout[0][:, 0])), ro_ch = channel) / 8)  # create the timestamps for each sample,
-                                                                                    # divide by 8 is due to ADC ticks being 8
-                                                                                    # times slower than the real clock cycles
+            for i in range(0, number_of_expt, max_batch_size):
+                this_batch = min(max_batch_size, number_of_expt - i)
+
+                buffer = buffers[batch % RING_BUFFERS]
+                out = buffer[:this_batch] if buffer is not None else None # a view, nothing is copied
+                shots = GeneratePulse(soc, pulse_type, frequency, pulse_width, amplitude, pulse_count, trigger_delay, this_batch, channel, out=out, size=min(max_batch_size, number_of_expt)) # execute the main function
+                if buffer is None:
+                    buffers[batch % RING_BUFFERS] = shots.base # the whole new buffer, shots are its first this_batch rows
+
+                yield sweep_header, shots
+                batch += 1
+
+    full_time_row = None
+
+    # stream the experiments in batches, so the memory used on the board does not depend on number_of_expt.
+    # the batches are acquired in a background thread while the previous batch is encoded and sent (see pipeline.py)
+    if stream_format == "json":
+        emit("[\n")
+
+    for batch_index, (sweep_header, shots) in enumerate(Pipelined(acquire_batches())):
+        if full_time_row is None:
+            full_time_row = (soc.cycles2us(np.arange(0, shots.shape[-1]), ro_ch = 0) / 8)  # create the timestamps for each sample,
+                                                                                                  # divide by 8 is due to ADC ticks being 8
+                                                                                                  # times slower than the real clock cycles
             
-    time_row = time_row + time_row[8] # since get_mr() function deletes the first 8 samples of the ADC (they are junk from
-                                      # previous reads), we add that lost time back.
-    
-    # create the response
-    result = {
-        "array": np.vstack((readout[:, :, 0], time_row)).tolist()
-    }
-    
-    json.dump(result, sys.stdout) # send the response to the handler (server.py)
+            full_time_row = full_time_row + full_time_row[8] # since get_mr() function deletes the first 8 samples of the ADC (they are junk from
+                                                             # previous reads), we add that lost time back.
+
+        # keep only the requested part of the readout, before anything is encoded
+        shots, time_row = CropAndDecimate(shots, full_time_row, window_start, window_stop, decimation)
+
+        # create the response of this batch, the time row is only sent with the first batch.
+        # the encoding is timed separately from the acquisition and from sending the batch
+        with metrics.stage("encode"):
+            chunk = EncodeBatch(dict(sweep_header, batch_index=batch_index, **channel_header), shots, time_row if batch_index == 0 else None, stream_format, reduce)
+
+        emit(chunk) # send the batch to the handler (server.py or the worker)
+        metrics.increment("shots", len(shots))
+        metrics.increment("batches")
+
+    if stream_format == "json":
+        emit("]\n")
+
+def main():
+
+    soc = QickSoc() # type: ignore # load the overlay, this is the slow part of the startup
+
+    # get the data from the server.py call, and stream the output to stdout
+    def emit(chunk):
+        if isinstance(chunk, bytes):
+            sys.stdout.buffer.write(chunk) # binary frames
+        else:
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+
+    RunExperiment(soc, json.load(sys.stdin), emit)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
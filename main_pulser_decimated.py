@@ -2,76 +2,104 @@
 
 import sys
 import json
-import gc
-import time
 
-from qick import * # type: ignore
-from drivers.RBSupport import generate_2qgateset # type: ignore
+from qick import QickSoc, AveragerProgram, RAveragerProgram # type: ignore
+from drivers.RBSupport import generate_2qgateset, waveform_aliases # type: ignore
+from program_cache import program_cache
+from metrics import metrics
+from wire_format import CompactArray, EncodeFrame
+from running_stats import RunningStats
+from sweep import SweepPoints, SweepConfig
+from pipeline import Pipelined, RING_BUFFERS
+from integrate import ComplexTraces, IntegrationWeights, Integrate, HistogramRange, IQHistograms, MAX_HISTOGRAM_BINS
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-soc = QickSoc() # type: ignore
-soccfg = soc
+# page 0 register counting the pulses of a train. the loops of the base classes use page 0 as well, AveragerProgram
+# registers 14 and 15 and RAveragerProgram registers 13 (the shot counter), 14 and 15, so the train takes 12
+TRAIN_REGISTER = 12
 
-class PulseSequence(AveragerProgram): # type: ignore
+# pulse methods shared by PulseSequence and PulseSweep
+class PulseSequenceBase:
     def initialize_phases(self):
         ## Prepare state
         self.phase_ref_q1 = 0
         self.phase_ref_q2 = 0
         self.phase_ref_c = 0
     
+    def set_gate_registers(self, q, name):
+        # set the pulse registers of the channel of qubit q ("Q1" or "Q2") for the given gate, returns the channel
+        if q == "Q1": # Qubit 1
+            ch, freq, phase_ref = self.cfg["q1_ch"], self.freq_q1, self.phase_ref_q1
+        else:
+            ch, freq, phase_ref = self.cfg["q2_ch"], self.freq_q2, self.phase_ref_q2
+
+        ginfo = self.cfg["gate_set"][name]
+        phase = self.deg2reg(phase_ref + ginfo["phase"], gen_ch=ch)
+
+        if self.cfg["pulse_style"] == "flat_top":
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     waveform=self.waveforms[name], phrst = 0,
+                                     length = self.cfg["length"])
+        elif self.cfg["pulse_style"] == "const":
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     phrst = 0, mode="oneshot",
+                                     length = self.cfg["length"])
+        else:
+            self.set_pulse_registers(ch=ch, freq=freq, phase=phase, gain=ginfo["gain"],
+                                     waveform=self.waveforms[name], phrst = 0, mode="oneshot")
+        return ch
+
+    def gate_cycles(self, q, name):
+        # length of the gate in tProcessor cycles, the envelope has samps_per_clk samples per generator cycle
+        ch = self.cfg["q1_ch"] if q == "Q1" else self.cfg["q2_ch"]
+
+        if self.cfg["pulse_style"] == "const":
+            gen_cycles = self.cfg["length"]
+        else:
+            gen_cycles = len(self.cfg["gate_set"][name]["idata"]) // self.soccfg["gens"][ch]["samps_per_clk"]
+            if self.cfg["pulse_style"] == "flat_top":
+                gen_cycles += self.cfg["length"] # the flat part sits between the two halves of the envelope
+
+        return self.us2cycles(self.cycles2us(gen_cycles, gen_ch=ch))
+
     def play_seq(self, seq):
         for g in seq:
             for q in g:
-                if q == "Q2":
-                    ginfo=self.cfg["gate_set"][g[q]]
-
-                    if self.cfg["pulse_style"] == "flat_top":
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 0,
-                                                    length = self.cfg["length"])
-                    elif self.cfg["pulse_style"] == "const":
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    phrst = 0, mode="oneshot",
-                                                    length = self.cfg["length"])
-                    else:
-                        self.set_pulse_registers(ch=self.cfg["q2_ch"], freq=self.freq_q2,
-                                                    phase=self.deg2reg(self.phase_ref_q2 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q2_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 0, mode="oneshot")
-                    self.pulse(ch=self.cfg["q2_ch"])
-
-                if q == "Q1": # Qubit 1
-                    ginfo=self.cfg["gate_set"][g[q]]
-
-                    if self.cfg["pulse_style"] == "flat_top":
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                    phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                    waveform=g[q], phrst = 0,
-                                                    length = self.cfg["length"])
-                    elif self.cfg["pulse_style"] == "const":
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                    phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                    gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                    phrst = 0, mode="oneshot",
-                                                    length = self.cfg["length"])
-                    else:
-                        self.set_pulse_registers(ch=self.cfg["q1_ch"], freq=self.freq_q1,
-                                                 phase=self.deg2reg(self.phase_ref_q1 + ginfo["phase"],
-                                                 gen_ch=self.cfg["q1_ch"]), gain=ginfo["gain"], 
-                                                 waveform=g[q], phrst = 0, mode="oneshot")
-
-                    self.pulse(ch=self.cfg["q1_ch"])
+                ch = self.set_gate_registers(q, g[q])
+                self.pulse(ch=ch)
             ################
            #modified sync_all with only DAC clocks, no ADC clocks
             self.synci(self.us2cycles(0.01))
-    
+
+    def play_train(self, seq, count, channels = None):
+        # play seq count times back to back. instead of unrolling the train, the tProcessor loops over it, so
+        # the program size and the compile time do not depend on count. every pulse starts at t=0 and
+        # the reference time is moved forward by the gate length, which keeps the pulses back to back.
+        # channels can be given if the registers of a single gate sequence are already set (see PulseSweep).
+        if count < 1:
+            return
+        if count == 1 and channels is None:
+            self.play_seq(seq)
+            return
+
+        # with a single gate the registers keep their values during the whole train, so they are set only once
+        if channels is None and len(seq) == 1:
+            channels = {q: self.set_gate_registers(q, seq[0][q]) for q in seq[0]}
+
+        if count > 1:
+            self.regwi(0, TRAIN_REGISTER, count - 1)
+            self.label("PULSE_TRAIN")
+
+        for g in seq:
+            for q in g:
+                ch = channels[q] if channels is not None else self.set_gate_registers(q, g[q])
+                self.pulse(ch=ch, t=0)
+            self.synci(max(self.gate_cycles(q, g[q]) for q in g))
+
+        if count > 1:
+            self.loopnz(0, TRAIN_REGISTER, "PULSE_TRAIN") # repeats until the counter runs out
+
     def initialize(self):
         cfg = self.cfg
         self.gate_seq = cfg['gate_seq']
@@ -98,7 +126,10 @@ class PulseSequence(AveragerProgram): # type: ignore
         self.freq_q1 = self.freq2reg(cfg["q1_pulse_freq"], gen_ch=cfg["q1_ch"], ro_ch=cfg["q1_ro_ch"])
         self.freq_q2 = self.freq2reg(cfg["q2_pulse_freq"], gen_ch=cfg["q2_ch"], ro_ch=cfg["q2_ro_ch"])
 
-        for name, ginfo in self.gate_set.items():
+        # upload only the gates that are played, and gates with identical I/Q data only once
+        self.waveforms = waveform_aliases(self.gate_set, self.gate_seq)
+        for name in dict.fromkeys(self.waveforms.values()):
+            ginfo = self.gate_set[name]
             self.add_pulse(ch=cfg["q1_ch"], name=name,
                            idata=ginfo["idata"],
                            qdata=ginfo["qdata"],
@@ -130,14 +161,280 @@ class PulseSequence(AveragerProgram): # type: ignore
                      adc_trig_offset=self.cfg["adc_trig_offset"])
 
         self.initialize_phases()
-        self.play_seq(self.gate_seq)
+        self.play_train(self.gate_seq, self.cfg.get("pulse_count", 1))
         self.wait_all()
         self.sync_all(self.us2cycles(self.cfg["relax_delay"]))
 
-def main():
-    
-    # get the data from the server.py call
-    data = json.load(sys.stdin)
+class PulseSequence(PulseSequenceBase, AveragerProgram): # type: ignore
+    pass
+
+class PulseSweep(PulseSequenceBase, RAveragerProgram): # type: ignore
+    # the same pulses as PulseSequence, with the frequency or the gain of both generators stepped by the
+    # tProcessor after every sweep point (cfg["expts"] points, cfg["reps"] shots each), so a whole sweep
+    # runs as one program. the pulse registers are set once and only the swept register changes in between,
+    # so only single gate sequences can be swept. the readout frequencies are not swept.
+
+    def initialize(self):
+        super().initialize()
+
+        self.initialize_phases()
+        gate = self.gate_seq[0]
+        self.channels = {q: self.set_gate_registers(q, gate[q]) for q in gate} # start values of the sweep
+
+        # register and step (in register units) of the swept parameter for every generator
+        self.sweep_steps = []
+        for ch in self.channels.values():
+            if self.cfg["sweep_parameter"] == "freq":
+                step = self.freq2reg(abs(self.cfg["step"]), gen_ch=ch)
+            else:
+                step = int(abs(self.cfg["step"]))
+            self.sweep_steps.append((self.ch_page(ch), self.sreg(ch, self.cfg["sweep_parameter"]), step))
+
+    def body(self):
+        # Trigger measurement
+        self.trigger(adcs=self.ro_chs,
+                     pins=[0],
+                     adc_trig_offset=self.cfg["adc_trig_offset"])
+
+        self.play_train(self.gate_seq, self.cfg.get("pulse_count", 1), channels=self.channels)
+        self.wait_all()
+        self.sync_all(self.us2cycles(self.cfg["relax_delay"]))
+
+    def update(self):
+        # move to the next sweep point
+        op = "+" if self.cfg["step"] >= 0 else "-"
+        for page, reg, step in self.sweep_steps:
+            self.mathi(page, reg, reg, op, step)
+
+def GetProgram(soc, config, program_class = PulseSequence):
+
+    """
+    This function returns the compiled program for the config, reusing it from the program cache
+    if the same pulse configuration was run before.
+    """
+
+    prog = program_cache.get(program_class, config)
+    if prog is None:
+        with metrics.stage("compile"):
+            config["gate_set"] = generate_2qgateset(config)
+            prog = program_class(soc, config) # initiate the pulse program which does everything
+        program_cache.put(program_class, config, prog)
+
+    return prog
+
+def MaxReps(soc, config):
+
+    """
+    This function returns how many shots fit in the decimated buffer, i.e. how many
+    repetitions the tProcessor can run in a single program execution.
+    """
+
+    try:
+        buffer_length = min(soc["readouts"][ch]["buf_maxlen"] for ch in config["ro_chs"])
+    except (KeyError, TypeError):
+        return 1 # unknown buffer size, fall back to one shot per execution
+
+    return max(1, buffer_length // config["readout_length"])
+
+def SplitReps(iq, reps, out):
+
+    """
+    This function copies the output of acquire_decimated into out, indexed by (shot, channel, I/Q, sample).
+    Depending on the QICK version, the shots of each channel come either as a (shot, I/Q, sample) array or
+    back to back in a single (I/Q, shot * sample) array. Sweeps have one more leading axis for the sweep
+    points, which are in the order they were played, like the shots.
+    """
+
+    for ch, d in enumerate(iq):
+        d = np.asarray(d)
+        if d.ndim == 2:
+            d = d.reshape(2, reps, -1).transpose(1, 0, 2)
+        out[:, ch] = d.reshape(reps, 2, -1)
+
+def ShotBuffer(soc, iq, reps, size):
+
+    """
+    This function allocates the shot buffer for size shots, indexed by (shot, channel, I/Q, sample),
+    using the first output of acquire_decimated (holding reps shots) to find the number of samples.
+    It returns the buffer and the time row.
+    """
+
+    # samples per shot, the shots are either on their own axis or back to back (see SplitReps)
+    first_channel = np.asarray(iq[0])
+    no_of_samples = first_channel.shape[-1] if first_channel.ndim >= 3 else first_channel.shape[-1] // reps
+    buffer = np.empty((size, len(iq), 2, no_of_samples), dtype=np.float32)
+    time_row = soc.cycles2us(np.arange(0, no_of_samples), ro_ch=0)
+
+    return buffer, time_row
+
+def AcquireShots(soc, config, reps, program_class = PulseSequence):
+
+    """
+    This function runs the program once with the given number of repetitions, using the repetition
+    loop of the tProcessor, and returns the raw output of acquire_decimated.
+    """
+
+    prog = GetProgram(soc, dict(config, reps=reps), program_class) # one compiled program per number of repetitions
+
+    with metrics.stage("acquire"):
+        soc.reset_gens() # clear out any DC or periodic values from the generator channels
+        iq = prog.acquire_decimated(soc, load_pulses=program_cache.needs_upload(prog), progress=False) # waveforms are uploaded only if they are not on the board already
+    program_cache.mark_loaded(prog)
+
+    return iq
+
+def Batches(soc, config, number_of_expt, max_batch_size, max_reps, ring = 1):
+
+    """
+    This function acquires number_of_expt shots and yields them batch by batch as (header, shots, time_row),
+    with shots indexed by (shot, channel, I/Q, sample). The shots are a view into one of ring buffers which
+    are reused in turn, so they have to be used before ring more batches are requested (see pipeline.py).
+    """
+
+    buffers = [None] * ring # shot buffers, allocated once and reused in turn by the batches
+
+    for batch, i in enumerate(range(0, number_of_expt, max_batch_size)):
+        this_batch = min(max_batch_size, number_of_expt - i)
+        buffer = buffers[batch % ring]
+
+        # the whole batch runs in as few program executions as the decimated buffer allows
+        for done in range(0, this_batch, max_reps):
+            reps = min(max_reps, this_batch - done)
+            iq = AcquireShots(soc, config, reps)
+
+            if buffer is None:
+                buffer, time_row = ShotBuffer(soc, iq, reps, min(max_batch_size, number_of_expt))
+                buffers[batch % ring] = buffer
+
+            SplitReps(iq, reps, out=buffer[done:done + reps])
+
+        yield {}, buffer[:this_batch], time_row # a view, nothing is copied
+
+def SweepBatches(soc, config, sweep, number_of_expt, max_batch_size, max_reps, ring = 1):
+
+    """
+    This function acquires number_of_expt shots for every point of a sweep and yields them like Batches,
+    one batch per point (more if number_of_expt is larger than max_batch_size), with the sweep_index and
+    the sweep_value of the point in the header. If the shots of several points fit in the decimated buffer,
+    these points run in a single program execution with the swept register stepped by the tProcessor.
+    Otherwise every point runs as a normal acquisition with its own program. The buffers are reused like in Batches,
+    the points of one program execution share a buffer.
+    """
+
+    parameter = sweep["parameter"]
+    values = SweepPoints(sweep)
+
+    if number_of_expt > min(max_reps, max_batch_size):
+        for index, value in enumerate(values):
+            for header, shots, time_row in Batches(soc, SweepConfig(config, parameter, value), number_of_expt, max_batch_size, max_reps, ring):
+                yield dict(header, sweep_index=index, sweep_value=float(value)), shots, time_row
+        return
+
+    points_per_run = max_reps // number_of_expt
+    buffers = [None] * ring
+
+    for run, first in enumerate(range(0, len(values), points_per_run)):
+        points = min(points_per_run, len(values) - first)
+        buffer = buffers[run % ring]
+
+        # the program starts from the first point of this run, the RAveragerProgram loop does the rest
+        run_config = SweepConfig(config, parameter, values[first])
+        run_config.update({"sweep_parameter": parameter, "start": float(values[first]), "step": float(sweep["step"]), "expts": points})
+        iq = AcquireShots(soc, run_config, number_of_expt, PulseSweep)
+
+        if buffer is None:
+            buffer, time_row = ShotBuffer(soc, iq, points * number_of_expt, points_per_run * number_of_expt)
+            buffers[run % ring] = buffer
+
+        SplitReps(iq, points * number_of_expt, out=buffer[:points * number_of_expt])
+
+        for p in range(points):
+            shots = buffer[p * number_of_expt:(p + 1) * number_of_expt]
+            yield {"sweep_index": first + p, "sweep_value": float(values[first + p])}, shots, time_row
+
+def EncodeBatch(header, shots, time_row, stream_format, reduce):
+
+    """
+    This function encodes one batch of shots, indexed by (shot, channel, I/Q, sample), as a binary frame
+    or as a JSON line. If reduce is True, only the mean, variance and count of the batch are encoded.
+    The time row is included if it is not None.
+    """
+
+    if reduce:
+        # only the statistics of the batch are sent, not the shots
+        stats = RunningStats()
+        stats.update(shots)
+
+        if stream_format == "binary":
+            arrays = {"mean": stats.mean.astype("<f4"), "variance": stats.variance().astype("<f4")}
+            if time_row is not None:
+                arrays["time_row"] = time_row
+            return EncodeFrame(dict(header, count=stats.count), arrays)
+
+        batch_result = dict(header, count=stats.count, mean=stats.mean.tolist(), variance=stats.variance().tolist())
+    else:
+        if stream_format == "binary":
+            # raw little-endian buffers
+            arrays = {"iq": CompactArray(shots)}
+            if time_row is not None:
+                arrays["time_row"] = time_row
+            return EncodeFrame(header, arrays)
+
+        batch_result = dict(header,
+                            ch0_I=shots[:, 0, 0].tolist(),
+                            ch0_Q=shots[:, 0, 1].tolist(),
+                            ch1_I=shots[:, 1, 0].tolist(),
+                            ch1_Q=shots[:, 1, 1].tolist())
+
+    batch_result["time_row"] = time_row.tolist() if time_row is not None else None
+    return json.dumps(batch_result) + "\n"
+
+def EncodeIntegrated(header, values, histograms, stream_format, reduce):
+
+    """
+    This function encodes one batch of integrated shots, one complex value per shot and channel, as a binary
+    frame or as a JSON line. If reduce is True, only the mean, variance and count of I and Q are encoded
+    instead of the values. The I/Q histograms, indexed by (channel, I bin, Q bin), are included if they are not None.
+    """
+
+    arrays = {}
+    if reduce:
+        stats = RunningStats()
+        stats.update(np.stack([values.real, values.imag], axis=-1)) # statistics indexed by (channel, I/Q)
+        header = dict(header, count=stats.count)
+        arrays["mean"] = stats.mean.astype("<f4")
+        arrays["variance"] = stats.variance().astype("<f4")
+    else:
+        arrays["iq"] = values.astype("<c8", copy=False)
+
+    if histograms is not None:
+        arrays["histogram"] = histograms
+
+    if stream_format == "binary":
+        return EncodeFrame(header, arrays)
+
+    if reduce:
+        batch_result = dict(header, mean=arrays["mean"].tolist(), variance=arrays["variance"].tolist())
+    else:
+        batch_result = dict(header,
+                            ch0_I=values[:, 0].real.tolist(),
+                            ch0_Q=values[:, 0].imag.tolist(),
+                            ch1_I=values[:, 1].real.tolist(),
+                            ch1_Q=values[:, 1].imag.tolist())
+    if histograms is not None:
+        batch_result["histogram"] = histograms.tolist()
+
+    return json.dumps(batch_result) + "\n"
+
+def RunExperiment(soc, data, emit):
+
+    """
+    This function runs one request on an already initialized QickSoc. It takes the soc, the
+    request parameters (same as the JSON sent to server.py) and an emit function that is called
+    with every chunk of the output stream (text lines or binary frames). This way the same code runs as a script and inside the persistent worker.
+    """
+
+    # get the parameters of the request
     pulse_type = data.get("type")
     pulse_frequency = data.get("freq")
     pulse_width = data.get("width") # in ns
@@ -147,9 +444,23 @@ def main():
     number_of_expt = data.get("number_of_expt")
     max_batch_size = data.get("max_batch_size", 1000) # default is 1000
     read_freq = data.get("read_freq")
+    stream_format = data.get("format", "json") # "json" for text lines, "binary" for wire_format frames
+    reduce = bool(data.get("reduce", False)) # if True, only the mean, variance and count of each batch are sent
+    sweep = data.get("sweep") # optional sweep of freq or gain, number_of_expt experiments per point (see sweep.py)
+
+    # "integrated" mode sends one I/Q value per shot and channel instead of the traces (see integrate.py)
+    integrated = data.get("mode") == "integrated"
+    window_start = data.get("window_start") # integration window in ns, None for the start or the end of the readout
+    window_stop = data.get("window_stop")
+    weighting = data.get("weighting", "boxcar") # "boxcar" or "matched" to the mean trace of the first batch
+    demod_freq = float(data.get("demod_freq", 0)) # extra digital demodulation in MHz, on top of the readout frequency
+    histogram_bins = int(data.get("histogram_bins", 0)) # I/Q histogram bins per axis, 0 for no histograms
+    histogram_range = data.get("histogram_range") # [low, high] of both axes, taken from the first batch if not given
 
     # safety checks for the input parameters
-    if max_batch_size <= 0 or max_batch_size > 3000:
+    if stream_format not in ["json", "binary"]:
+        stream_format = "json"
+    if max_batch_size <= 0 or max_batch_size > (10000 if stream_format == "binary" else 3000): # JSON text needs much more memory than the shot buffer
         max_batch_size = 1000
     if pulse_type not in ["gaussian", "flat_top", "const"]:
         pulse_type = "gaussian"
@@ -159,6 +470,10 @@ def main():
         pulse_amplitude = 30000
     if pulse_width < 0 or pulse_width > 50:
         pulse_width = 10
+    if integrated and (histogram_bins < 0 or histogram_bins > MAX_HISTOGRAM_BINS):
+        raise ValueError(f"histogram_bins must be between 0 and {MAX_HISTOGRAM_BINS}")
+    if integrated and window_start is not None and window_stop is not None and window_start >= window_stop:
+        raise ValueError("window_start must be before window_stop")
 
     q1_pulse_freq = pulse_frequency
     q1_read_freq = read_freq
@@ -197,55 +512,69 @@ def main():
     elif pulse_type == "const":
         config["pulse_style"] = "const"
       
-    config["gate_set"] = generate_2qgateset(config)
-
     # get the desired sequence of gates (pi pulses). for now, only X gates are applied.
-    config['gate_seq'] = [{'Q1': 'X', 'Q2': 'X'}] * pulse_count
+    # the sequence is repeated pulse_count times by a loop in the tProcessor
+    config['gate_seq'] = [{'Q1': 'X', 'Q2': 'X'}]
+    config['pulse_count'] = pulse_count
+
+    max_reps = MaxReps(soc, config) # shots per program execution, limited by the decimated buffer
+
+    # the batches are acquired in a background thread while the previous batch is encoded and sent (see pipeline.py)
+    if sweep:
+        batches = SweepBatches(soc, config, sweep, number_of_expt, max_batch_size, max_reps, RING_BUFFERS)
+    else:
+        batches = Batches(soc, config, number_of_expt, max_batch_size, max_reps, RING_BUFFERS)
+
+    # do the measurement in batches to avoid memory issues, the time row is only sent with the first batch
+    if stream_format == "json":
+        emit("[\n")
+
+    weights = None # integration weights, fixed by the first batch
+
+    for batch_index, (header, shots, time_row) in enumerate(Pipelined(batches)):
+        header = dict(header, batch_index=batch_index)
+
+        if integrated:
+            with metrics.stage("integrate"):
+                traces = ComplexTraces(shots, time_row, demod_freq)
+                if weights is None:
+                    weights = IntegrationWeights(traces, time_row, window_start, window_stop, weighting)
+                values = Integrate(traces, weights)
+
+                histograms = None
+                if histogram_bins:
+                    if histogram_range is None:
+                        histogram_range = HistogramRange(values) # the same bins for every batch, so the histograms add up
+                    histograms = IQHistograms(values, histogram_bins, histogram_range)
+                    header["histogram_range"] = [float(x) for x in histogram_range]
+
+            with metrics.stage("encode"):
+                chunk = EncodeIntegrated(header, values, histograms, stream_format, reduce)
+        else:
+            # the encoding is timed separately from the acquisition and from sending the batch
+            with metrics.stage("encode"):
+                chunk = EncodeBatch(header, shots, time_row if batch_index == 0 else None, stream_format, reduce)
 
-    prog = PulseSequence(soccfg, config) # initiate the pulse program which does everything
+        emit(chunk) # send the batch to the handler (server.py or the worker)
+        metrics.increment("shots", len(shots))
+        metrics.increment("batches")
 
-    # acquire a single shot to define time row
-    soc.reset_gens() # clear out any DC or periodic values from the generator channels
-    iq_sample = prog.acquire_decimated(soc, load_pulses=True, progress=False)
-    time_row = soc.cycles2us(np.arange(0, len(iq_sample[0, 0])), ro_ch=0)
+    if stream_format == "json":
+        emit("]\n")
 
-    # do the measurement in batches to avoid memory issues
-    print("[", flush=True)
+def main():
 
-    for i in range(0, number_of_expt, max_batch_size):
-        this_batch = min(max_batch_size, number_of_expt - i)
+    soc = QickSoc() # type: ignore # load the overlay, this is the slow part of the startup
+
+    # get the data from the server.py call, and stream the output to stdout
+    def emit(chunk):
+        if isinstance(chunk, bytes):
+            sys.stdout.buffer.write(chunk) # binary frames
+        else:
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
 
-        ch0_I = []
-        ch0_Q = []
-        ch1_I = []
-        ch1_Q = []
-
-        for _ in range(this_batch):
-            soc.reset_gens()
-            iq = prog.acquire_decimated(soc, load_pulses=False, progress=False)
-            ch0_I.append(iq[0, 0].tolist())
-            ch0_Q.append(iq[0, 1].tolist())
-            ch1_I.append(iq[1, 0].tolist())
-            ch1_Q.append(iq[1, 1].tolist())
-
-        batch_result = {
-            "batch_index": i // max_batch_size,
-            "ch0_I": ch0_I,
-            "ch0_Q": ch0_Q,
-            "ch1_I": ch1_I,
-            "ch1_Q": ch1_Q,
-            "time_row": time_row.tolist() if i == 0 else None
-        }
-
-        json.dump(batch_result, sys.stdout)
-        print("", flush=True)
-
-        # clean up to avoid memory issues
-        del ch0_I, ch0_Q, ch1_I, ch1_Q, iq
-        gc.collect()
-        time.sleep(0.1)
-
-    print("]", flush=True)
+    RunExperiment(soc, json.load(sys.stdin), emit)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,11 +2,19 @@ import requests
 from datetime import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import iirnotch, filtfilt, welch
+from scipy.signal import iirnotch, sosfiltfilt, welch
+from functools import lru_cache
 import time
 from vectormagnet_lib import MSS_Control
 from sc5511a_lib import SC5511A
 from bnc_lib import SignalGenerator855B
+from data_format import DataWriter, HeaderLines, EXTENSION
+from disk_writer import DiskWriter
+from running_stats import RunningStats
+from stream_decoder import StreamDecoder, DecodeChunks, READ_SIZE
+
+# writer thread of the data files, the rows of every batch are written in the background while the next batch is received
+disk_writer = DiskWriter()
 
 def PlotReadout(read, time_row, filename, no_of_experiments, channel):
     
@@ -57,19 +65,24 @@ def PlotPSD(data, filename, fs, no_of_experiments, channel):
     # plt.show()
     plt.close()
 
-def CalculateSNR(signal):
+def CalculateSNR(signal, time_row):
 
     """
     This function calculates the Signal-to-Noise Ratio (SNR) of the signal.
-    It takes the signal as input and returns the SNR in both linear and dB scale.
+    It takes the signal and its time row in ns as input and returns the SNR in both linear and dB scale.
     The SNR is calculated by taking the maximum amplitude of the pulse region and
     dividing it by the standard deviation of the noise region.
     """
 
-    pulse_region = signal[950:1390]
-    signal_amplitude = np.max(pulse_region) - np.min(pulse_region)
+    # the regions are given in ns, so they stay the same when the board crops or decimates the readout.
+    # they match the samples 950:1390 (pulse) and 1540: (noise) of the full-rate readout
+    pulse_region = signal[(time_row >= 216.56) & (time_row < 316.02)]
+    noise_region = signal[time_row >= 349.93]
+    if len(pulse_region) == 0 or len(noise_region) == 0:
+        print("Readout window does not cover the pulse and noise regions, SNR is not calculated")
+        return np.nan, np.nan
 
-    noise_region = signal[1540:]
+    signal_amplitude = np.max(pulse_region) - np.min(pulse_region)
     noise_amplitude = np.std(noise_region)
 
     snr = signal_amplitude / noise_amplitude
@@ -77,66 +90,95 @@ def CalculateSNR(signal):
 
     return snr, snr_dB
 
-def StartTXTFile(filename, timestamp, sample, channel, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_field, magnet_field_rate, LO_frequency,  LO_power, note):
+def StartDataFile(filename, file_format, timestamp, sample, channel, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_field, magnet_field_rate, LO_frequency,  LO_power, note):
     
     """
-    This function initiates a .txt file with a header containing metadata about the experiment.
+    This function initiates a data file with a header containing metadata about the experiment.
+    With file_format "txt" the metadata is written as "# ... #" lines of a .txt file, with "binary"
+    the same metadata is the JSON header of a .pgd file of data_format.py.
     """
 
-    file = open("data/data_" + filename + ".txt", "w")
-    file.write(f"# Date and Time: {timestamp} #\n")
-    file.write(f"# Sample: {sample} #\n")
-    file.write("# Channel: 0, sample #\n" if channel == 0 else "# Channel: 1, loopback #\n")
-    file.write(f"# Pulse Type: {payload['type']} #\n")
-    file.write(f"# Pulse Frequency and Width: {payload['freq']} MHz, {payload['width'] * 4} ns #\n")
-    file.write(f"# Pulse Amplitude: {payload['amplitude']} a.u. #\n")
+    metadata = {}  # the lines of the header in order, an entry without a value is written as it is
+    metadata["Date and Time"] = timestamp
+    metadata["Sample"] = sample
+    metadata["Channel"] = "0, sample" if channel == 0 else "1, loopback"
+    metadata["Pulse Type"] = payload['type']
+    metadata["Pulse Frequency and Width"] = f"{payload['freq']} MHz, {payload['width'] * 4} ns"
+    metadata["Pulse Amplitude"] = f"{payload['amplitude']} a.u."
     
-    if channel == 0:
-        file.write(f"# LO Frequency and Power: {LO_frequency} GHz, {LO_power} dBm #\n")
-        file.write(f"# Magnet Field: {magnet_field} T #\n")
-        file.write(f"# Magnet Field Rate: {magnet_field_rate} T/s #\n")
+    if payload["channel"] != 1: # the LO and the magnet are on unless only the loopback is read
+        metadata["LO Frequency and Power"] = f"{LO_frequency} GHz, {LO_power} dBm"
+        metadata["Magnet Field"] = f"{magnet_field} T"
+        metadata["Magnet Field Rate"] = f"{magnet_field_rate} T/s"
     else:
-        file.write("# LO and Magnet are disabled in loopback mode #\n")
+        metadata["LO and Magnet are disabled in loopback mode"] = None
     
-    file.write(f"# Number of Experiments: {number_of_experiments} #\n")
-    file.write(f"# Max Batch Size: {max_batch_size} #\n")
-    file.write(f"# Is each batch averaged?: {use_batch_average} #\n")
+    metadata["Number of Experiments"] = number_of_experiments
+    metadata["Max Batch Size"] = max_batch_size
+    metadata["Readout Window and Decimation"] = f"{payload.get('window_start')} to {payload.get('window_stop')} ns, {payload.get('decimation', 1)}"
+    metadata["Is each batch averaged?"] = use_batch_average
 
-    file.write(f"# Note: {note} #\n")
+    metadata["Note"] = note
 
     if use_batch_average:
-        file.write(f"# Data Format: Each row is a {max_batch_size}-experiment average #\n")
+        metadata["Data Format"] = f"Each row is a {max_batch_size}-experiment average"
     else:
-        file.write("# Data Format: Each row is an experiment #\n")
+        metadata["Data Format"] = "Each row is an experiment"
 
-    file.write("# The second-to-last row is the average of all rows above #\n")
-    file.write("# The last row is the time row in ns #\n")
-    file.close()
+    metadata["The second-to-last row is the average of all rows above"] = None
+    metadata["The last row is the time row in ns"] = None
 
-def AppendToTXTFile(filename, myrow):
+    if file_format == "txt":
+        file = open("data/data_" + filename + ".txt", "w")
+        file.writelines(HeaderLines(metadata))
+        file.close()
+    else:
+        DataWriter("data/data_" + filename + EXTENSION, metadata, dtype = "<f8").close()
+
+def AppendToDataFile(filename, file_format, myrow, kind = "data"):
 
     """
-    This function appends a row of data to the .txt file.
-    It takes the filename and the row of data as input.
+    This function appends rows of data to the data file.
+    It takes the filename, the file format, the rows of data and their kind ("data", "average" or "time") as input.
     """
 
     if not isinstance(myrow, np.ndarray):
         raise TypeError("Input must be a numpy array")
     
-    # append the data to the file
-    file = open("data/data_" + filename + ".txt", "a")
-    np.savetxt(file, myrow, fmt = "%.18e", delimiter = ",")
-    file.close()
+    # the rows are written by the writer thread, the file stays open until disk_writer.finish()
+    path = "data/data_" + filename + (".txt" if file_format == "txt" else EXTENSION)
+    disk_writer.append(path, file_format, myrow, kind, fmt = "%.18e")
+
+@lru_cache(maxsize=None)
+def NotchFilterBank(fs, harmonics, Q):
+
+    """
+    This function designs one notch filter for each of the harmonics (a tuple, in Hz) at the sampling frequency fs
+    and returns them as a single cascade of second-order sections, one row of (b0, b1, b2, a0, a1, a2) per notch.
+    It is cached, so every filter bank is only designed once per process, and the array is shared by its callers.
+    """
+
+    sos = np.zeros((len(harmonics), 6))
+    for i, f_h in enumerate(harmonics):
+        b, a = iirnotch(f_h / (fs / 2), Q)  # normalized frequency (0 to 1)
+        sos[i, :3], sos[i, 3:] = b, a
+
+    return sos
 
-def CreateNotchFilter(fs):
+def CreateNotchFilter(fs, adc_fs = None):
 
     """
     This function creates a notch filter to filter out the harmonics of the fundamental frequency.
-    It takes the raw signal and the sampling frequency as input, and returns the notch filter coefficients.
+    It takes the sampling frequency of the data and the sampling frequency of the ADC (only different if the
+    board decimated the data, None if they are the same), and returns the notch filters as second-order sections.
+    Harmonics above the Nyquist frequency of the data are already removed by the board and are skipped.
     """
     
+    if adc_fs is None:
+        adc_fs = fs
+
     # define notch filter parameters
-    f0 = fs / 8  # fundamental frequency to filter out (in Hz)
+    f0 = adc_fs / 8  # fundamental frequency to filter out (in Hz), the interleaving spur of the ADC
     harmonics = [f0 * i for i in range (1, 5)]  # harmonics to filter out (in Hz)
 
     # add some additional harmonics that are not exact multiples of the fundamental frequency
@@ -147,27 +189,43 @@ def CreateNotchFilter(fs):
 
     Q = 30.0  # quality factor for the notch filter, adjust for narrower or wider notches
 
-    # Create notch filters for each harmonic
-    notch_filters = []
-    for f_h in harmonics:
-        w0 = f_h / (fs / 2)  # Normalized frequency (0 to 1)
-        b, a = iirnotch(w0, Q)
-        notch_filters.append((b, a))
-    
-    return notch_filters
+    # skip the harmonics above the Nyquist frequency of the decimated data. a harmonic exactly at the Nyquist
+    # frequency (adc_fs / 8 * 4 without decimation) is kept, iirnotch designs it with w0 = 1 as before
+    harmonics = tuple(f_h for f_h in harmonics if f_h <= fs / 2)
+
+    return NotchFilterBank(fs, harmonics, Q)
 
 def ApplyNotchFilter(raw_signal, filter_coeff):
 
     """
     This function applies the notch filter to the raw signal. It takes the raw signal and the filter coefficients as input,
-    and returns the filtered signal.
+    and returns the filtered signal. All the notches are applied in a single forward-backward pass along the last axis,
+    so a whole batch of shots, indexed by (experiment, sample), is filtered at once.
     """
 
-    filtered_signal = raw_signal.copy()
-    for b, a in filter_coeff:
-        filtered_signal = filtfilt(b, a, filtered_signal)
-    
-    return filtered_signal
+    if len(filter_coeff) == 0:
+        return np.array(raw_signal, dtype=np.float64)  # every harmonic is above the Nyquist frequency of the data
+
+    # the default padding of sosfiltfilt, shortened for readout windows with only a few samples. the whole cascade
+    # is padded and started at once, while the old filter (filtfilt once per notch) padded every notch by itself, so
+    # the edges differ from it: by tens of counts at the first and last sample, more than 1 count over the first
+    # ~300 and the last ~400 samples, and more than 1e-6 over ~2500 samples from either edge (narrow notches settle slowly)
+    padlen = min(3 * (2 * len(filter_coeff) + 1), np.shape(raw_signal)[-1] - 1)
+    return sosfiltfilt(filter_coeff, raw_signal, axis=-1, padlen=padlen)
+
+def ReadBinaryBatches(frames):
+
+    """
+    This function takes the binary frames of the board, as (header, arrays) from stream_decoder.py, and yields
+    every batch as a dictionary, in the same layout as the batches of the JSON stream. The arrays are views into
+    the received buffers, no copies are made.
+    """
+
+    for header, arrays in frames:
+        batch = dict(header)
+        batch.update(arrays)  # "shots" indexed by (experiment, sample), or "mean" and "variance" if reduced
+        batch.setdefault("time_row", None)
+        yield batch
 
 def InitializeMagnet():
 
@@ -407,21 +465,57 @@ def GetLOStatus(instance):
 
     return temperature, rf_params, device_status
 
+def CheckInstruments(LO_inst, LO_frequency, LO_power, magnet_inst, magnet_field):
+
+    """
+    This function checks the LO and the magnet while the board is streaming the batches, without changing anything.
+    It returns a description of the fault, or None if the temperature of the LO, its settings and the magnetic field are fine.
+    """
+
+    (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
+    if LO_temp > 50:
+        return f"Local oscillator temperature is too high: {LO_temp} degC"
+    if ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
+        return "Local oscillator parameters are not set correctly anymore"
+
+    # check the field of the magnet
+    bx, by, bz = magnet_inst.TMon_getHallField()
+    if abs(float(bz) - magnet_field) > 1e-3:
+        return f"Magnetic field is {float(bz)} T instead of {magnet_field} T"
+
+    return None
+
+def CancelJob(job_id):
+
+    """
+    This function cancels a job of the board with DELETE /jobs/<id>, the id comes with the X-Job-Id header of /run.
+    The board stops acquiring after the batch it is working on.
+    """
+
+    response = requests.delete(f"http://128.174.248.50:5500/jobs/{job_id}", headers={"auth": "magnetism@ESB165"})
+    if response.status_code != 200:
+        print(f"Cancelling job {job_id} failed with status code {response.status_code}")
+
 def main(timestamp, sample, channel = 0, pulse_type = "gaussian", pulse_frequency = 120, pulse_width = 15, 
          pulse_amplitude = 30000, magnet_inst = None, magnet_field = 0.0, magnet_field_rate = 0.005, LO_inst = None, LO_frequency = 5.0, 
-         LO_power = 0.0, number_of_experiments = 1000, max_batch_size = 1000, use_batch_average = True,  note = ""):
+         LO_power = 0.0, number_of_experiments = 1000, max_batch_size = 1000, use_batch_average = True,  note = "", stream_format = "binary",
+         window_start = None, window_stop = None, decimation = 1, file_format = "binary"):
 
     """
     This main function sends a request to the Flask (a type of web server)
     server running on the board itself. Some parameters of the pulse is passed 
     with the request, and the readouts from ADCs are returned in JSON format 
-    from the board. This function then exports the data to a .txt file, detects
+    from the board. This function then exports the data to a data file, detects
     the pulses present, and plots the data.
     """
 
-    # raise an error if the max_batch_size is greater than 1000 to avoid memory issues on the board
-    if max_batch_size > 1000:
-        raise ValueError("max_batch_size cannot be greater than 1000 due to memory limitations of the board")
+    # raise an error if the max_batch_size is too large for the memory of the board, JSON text needs much more memory than binary frames
+    max_allowed_batch_size = 10000 if stream_format == "binary" else 1000
+    if max_batch_size > max_allowed_batch_size:
+        raise ValueError(f"max_batch_size cannot be greater than {max_allowed_batch_size} due to memory limitations of the board")
+
+    if file_format not in ["binary", "txt"]:
+        raise ValueError("Only supported file formats are 'binary' (.pgd) and 'txt'")
     
     if pulse_amplitude < 0 or pulse_amplitude > 32768:
         raise ValueError("Pulse amplitude must be between 0 and 32768")
@@ -432,7 +526,7 @@ def main(timestamp, sample, channel = 0, pulse_type = "gaussian", pulse_frequenc
     
     if channel == 1:
         print("Warning: Loopback ADC is selected, LO and magnet will be disabled.")
-    elif channel == 0:
+    elif channel in [0, "both"]:
         field_read = RampMagnet(magnet_inst, magnet_field, magnet_field_rate)  # turn on the magnet with specified field and rate
         time.sleep(5)  # wait for the magnet to stabilize
         if abs(field_read - magnet_field) > 0.001:  # check if the field is set correctly
@@ -447,7 +541,7 @@ def main(timestamp, sample, channel = 0, pulse_type = "gaussian", pulse_frequenc
             TurnOffLO(LO_inst)
             raise RuntimeError("Local oscillator parameters are not set correctly. Please check the settings.")
     else:
-        raise ValueError("Channel must be either 0 (ADC_D) or 1 (ADC_C)")
+        raise ValueError("Channel must be 0 (ADC_D), 1 (ADC_C) or 'both'")
 
     url = 'http://128.174.248.50:5500/run' # this is the URL address that the server on the board is listening
     
@@ -464,135 +558,186 @@ def main(timestamp, sample, channel = 0, pulse_type = "gaussian", pulse_frequenc
         'pulse_count': 1,                                   # number of pulses to be generated back to back in one experiment
         'trigger_delay': 1,                                 # delay amount of the triggering of the ADC buffer, essentially when to "press record", in us
                                                             # trigger_delay = 1 -> first pulse around t = 50ns
-        'number_of_expt': 1,                                # how many experiments to be done, just a placeholder, will be set later
-        'channel': channel                                  # which ADC channel to read, both of the DAC channels are generating the signal simultaneously
-                                                            # channel 0 -> ADC_D, channel 1 -> ADC_C
+        'number_of_expt': number_of_experiments,            # how many experiments to be done
+        'max_batch_size': max_batch_size,                   # maximum number of experiments in one batch, the board streams the batches one by one
+        'channel': channel,                                 # which ADC channel to read, both of the DAC channels are generating the signal simultaneously
+                                                            # channel 0 -> ADC_D, channel 1 -> ADC_C, "both" -> every experiment is read on both ADCs
                                                             # in our configuration, channel 0 is connected to the sample and channel 1 is in loopback
+        'reduce': use_batch_average,                        # if True, the board sends only the mean and variance of each batch
+        'format': stream_format,                            # format of the stream, "binary" frames or "json" text
+        'window_start': window_start,                       # start of the readout window in ns, None for the first sample. the board sends only the window
+        'window_stop': window_stop,                         # end of the readout window in ns, None for the last sample
+        'decimation': decimation                            # integer decimation factor of the readout on the board, with an anti-alias filter. 1 for no decimation
     }
 
     # define the notch filter coefficients, this is only done once since the filter coefficients are the same for all experiments
     fs = 4423.68e6 
-    notch_filters = CreateNotchFilter(fs)  # create the notch filter coefficients
+    notch_filters = CreateNotchFilter(fs / decimation, fs)  # create the notch filter coefficients, for the sampling rate after the decimation on the board
 
-    all_batches_data = []  # this will hold the average data from all batches of experiments
+    read_channels = [0, 1] if channel == "both" else [channel]  # ADC channels in the stream, in the order of its channel axis
+    channel_stats = {ch: RunningStats(extrema = True) for ch in read_channels}  # running mean, variance, min and max of every channel, the shots are not kept
 
-    # define a filename to be used
-    if channel == 0:
-        filename = f"{timestamp}_Sample={sample}_Pulse={pulse_type}_{payload['freq']}MHz_AvgN={number_of_experiments}_MagnetB={magnet_field}_T"
-    else:
-        filename = f"{timestamp}_Sample={sample}_Pulse={pulse_type}_{payload['freq']}MHz_AvgN={number_of_experiments}_Loopback"
-
-    # export the data to a .txt file
-    StartTXTFile(filename, timestamp, sample, channel, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_field, magnet_field_rate, LO_frequency, LO_power, note)
+    # define a filename to be used for every channel, the sample and the loopback are saved in separate files
+    filenames = {}
+    for ch in read_channels:
+        if ch == 0:
+            filenames[ch] = f"{timestamp}_Sample={sample}_Pulse={pulse_type}_{payload['freq']}MHz_AvgN={number_of_experiments}_MagnetB={magnet_field}_T"
+        else:
+            filenames[ch] = f"{timestamp}_Sample={sample}_Pulse={pulse_type}_{payload['freq']}MHz_AvgN={number_of_experiments}_Loopback"
 
-    for i in range(0, number_of_experiments, max_batch_size):
-        batch_size = min(max_batch_size, number_of_experiments - i) # number of experiments in this batch
-        new_payload = payload.copy() # copy the original payload
-        new_payload['number_of_expt'] = batch_size # set the number of experiments in this batch
+        # export the data to a data file
+        StartDataFile(filenames[ch], file_format, timestamp, sample, ch, payload, number_of_experiments, max_batch_size, use_batch_average, magnet_field, magnet_field_rate, LO_frequency, LO_power, note)
 
-        # do the checks for the LO and the magnet ONLY if we are reading from ADC_D (channel 0)
-        if channel == 0:
-            # check the status of the LO device, if it is too hot, wait for it to cool down
-            (LO_temp, LO_rf_params, LO_status) =  GetLOStatus(LO_inst)
-            if LO_temp > 50:
-                TurnOffLO(LO_inst)
-                print(f"Local oscillator temperature is too high: {LO_temp} degC. Waiting for it to cool down...")
+    # do the checks for the LO and the magnet ONLY if we are reading from ADC_D (channel 0)
+    if channel in [0, "both"]:
+        # check the status of the LO device, if it is too hot, wait for it to cool down
+        (LO_temp, LO_rf_params, LO_status) =  GetLOStatus(LO_inst)
+        if LO_temp > 50:
+            TurnOffLO(LO_inst)
+            print(f"Local oscillator temperature is too high: {LO_temp} degC. Waiting for it to cool down...")
 
-                # wait until the temperature is below 50 degC
-                while LO_temp > 50:
-                    time.sleep(5)
-                    (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
+            # wait until the temperature is below 50 degC
+            while LO_temp > 50:
+                time.sleep(5)
+                (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
 
-                # turn the LO back on after cooling down
-                TurnOnLO(LO_inst, freq = LO_frequency, power = LO_power)
-                time.sleep(1)
+            # turn the LO back on after cooling down
+            TurnOnLO(LO_inst, freq = LO_frequency, power = LO_power)
+            time.sleep(1)
 
-                # check if the LO parameters are set correctly
-                (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
-                if ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
-                    TurnOffLO(LO_inst)
-                    raise RuntimeError("Local oscillator parameters are not set correctly. Please check the settings.")
-            elif ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
-                print("Local oscillator parameters are not set correctly. Turning it off and trying again...")
+            # check if the LO parameters are set correctly
+            (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
+            if ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
                 TurnOffLO(LO_inst)
-                TurnOnLO(LO_inst, freq = LO_frequency, power = LO_power)
-                time.sleep(1)
-                
-                # if still not set correctly, raise an error
-                (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
-                if ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
-                    TurnOffLO(LO_inst)
-                    raise RuntimeError("Local oscillator parameters are not set correctly. Please check the settings.")
+                raise RuntimeError("Local oscillator parameters are not set correctly. Please check the settings.")
+        elif ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
+            print("Local oscillator parameters are not set correctly. Turning it off and trying again...")
+            TurnOffLO(LO_inst)
+            TurnOnLO(LO_inst, freq = LO_frequency, power = LO_power)
+            time.sleep(1)
             
-            # check the status of the magnet, if it is not set to the desired field, try again
+            # if still not set correctly, raise an error
+            (LO_temp, LO_rf_params, LO_status) = GetLOStatus(LO_inst)
+            if ((np.abs(LO_rf_params["rf1_freq"] - LO_frequency) > 1e-9) or (np.abs(LO_rf_params["rf1_level"] - LO_power) > 1e-3) or not LO_status["rf1_out_enable"] or LO_status["rf1_standby"]):
+                TurnOffLO(LO_inst)
+                raise RuntimeError("Local oscillator parameters are not set correctly. Please check the settings.")
+        
+        # check the status of the magnet, if it is not set to the desired field, try again
+        bx, by, bz = magnet_inst.TMon_getHallField()
+        bx = float(bx); by = float(by); bz = float(bz)
+        if np.abs(bz - magnet_field) > 1e-3:
+            bz = RampMagnet(magnet_inst, magnet_field, magnet_field_rate)
+            time.sleep(5)
             bx, by, bz = magnet_inst.TMon_getHallField()
             bx = float(bx); by = float(by); bz = float(bz)
-            if np.abs(bz - magnet_field) > 1e-3:
-                bz = RampMagnet(magnet_inst, magnet_field, magnet_field_rate)
-                time.sleep(5)
-                bx, by, bz = magnet_inst.TMon_getHallField()
-                bx = float(bx); by = float(by); bz = float(bz)
 
-                if abs(bz - magnet_field) > 1e-3:
-                    raise RuntimeError("Magnetic field not set correctly. Please check the settings.")
-
-        print(f"Sending batch of {batch_size} experiments...")
+            if abs(bz - magnet_field) > 1e-3:
+                raise RuntimeError("Magnetic field not set correctly. Please check the settings.")
+
+    print("Sending experiments...")
+
+    # send the actual request (HTTP request) to the board. don't forget to add the password. the board streams
+    # the experiments back batch by batch, so a single request covers all of them
+    response = requests.post(url, json=payload, headers={"auth": "magnetism@ESB165"}, stream=True)
+
+    # the board runs one experiment at a time, if its queue is full wait as long as it asks and try again
+    while response.status_code == 429:
+        retry_after = int(response.headers.get("Retry-After", 10))
+        print(f"Board is busy, trying again in {retry_after} s...")
+        time.sleep(retry_after)
+        response = requests.post(url, json=payload, headers={"auth": "magnetism@ESB165"}, stream=True)
+
+    # if the response is not OK, raise an error
+    if response.status_code != 200:
+        print(f"Request failed with status code {response.status_code}")
+        print("Response body:", response.text)
+        raise RuntimeError("Failed request")
+
+    # read the stream batch by batch, every batch is decoded once as soon as it is complete and binary frames
+    # are decoded without copies (see stream_decoder.py)
+    decoder = StreamDecoder(stream_format)
+    frames = DecodeChunks(response.iter_content(chunk_size=READ_SIZE), decoder)
+    batches = ReadBinaryBatches(frames) if stream_format == "binary" else frames
+
+    expected_batch_index = 0
+    print(f"Waiting for batch {expected_batch_index + 1}...")
+
+    for batch in batches:
+        # check if the batch is the expected one
+        index = batch.get("batch_index")
+        if index != expected_batch_index:
+            raise ValueError(f"Unexpected batch index: {index}, expected: {expected_batch_index}")
+        expected_batch_index += 1
+
+        print(f"Batch {expected_batch_index} acquired successfully.")
+
+        # the LO and the magnet are checked while the board streams, on a fault the job is cancelled and the run stopped
+        if channel in [0, "both"]:
+            fault = CheckInstruments(LO_inst, LO_frequency, LO_power, magnet_inst, magnet_field)
+            if fault is not None:
+                job_id = response.headers.get("X-Job-Id")
+                if job_id is not None:
+                    CancelJob(job_id)
+                response.close()
+                TurnOffLO(LO_inst)
+                raise RuntimeError(f"{fault}, job {job_id} cancelled, {expected_batch_index - 1} batches were processed")
 
-        # send the actual request (HTTP request) to the board. don't forget to add the password. get the response from the board 
-        response = requests.post(url, json=new_payload, headers={"auth": "magnetism@ESB165"})
+        if batch.get("time_row") is not None:
+            time_row = np.array(batch["time_row"]) * 1e3  # the time row comes only with the first batch, convert it to ns
 
-        # if the response is not OK, raise an error
-        if response.status_code != 200:
-            print(f"Request for batch {i} failed with status code {response.status_code}")
-            print("Response body:", response.text)
-            raise RuntimeError("Failed request")
-        
-        response = np.array(response.json()['array'])  # convert the response to JSON format and parse it
-        print(f"Batch {i // max_batch_size + 1} acquired successfully.")
-        
-        if i == 0:
-            time_row = response[-1] * 1e3  # the last row is the time row, we take it only once, convert it to ns
-        
-        data_part = response[:-1]  # all but the last row, which is the time row
+        for c, ch in enumerate(read_channels):
+            if use_batch_average:
+                # if we are using batch averaging, the board already sent the average of the batch.
+                # the notch filter is linear, so filtering the average is the same as averaging the filtered shots
+                batch_mean = np.asarray(batch["mean"])
+                batch_variance = np.asarray(batch["variance"])
+                avg_data = ApplyNotchFilter(batch_mean[c] if channel == "both" else batch_mean, notch_filters)
 
-        filtered_data_part = ApplyNotchFilter(data_part, notch_filters)  # apply the notch filter to the data part
+                # the variance is the one of the unfiltered shots, the notch filter only removes a few narrow spurs
+                channel_stats[ch].merge(batch["count"], avg_data, batch_variance[c] if channel == "both" else batch_variance)
 
-        if use_batch_average:
-            # if we are using batch averaging, we take the average of the data part
-            avg_data = np.mean(filtered_data_part, axis = 0)
-            all_batches_data.append(avg_data[np.newaxis, :])
+                AppendToDataFile(filenames[ch], file_format, avg_data[np.newaxis, :])  # append the average data row to the data file
+            else:
+                shots = np.asarray(batch["shots"])  # indexed by (experiment, sample), or (experiment, channel, sample) for both channels
+                filtered_data_part = ApplyNotchFilter(shots[:, c] if channel == "both" else shots, notch_filters)  # apply the notch filter to the shots
 
-            AppendToTXTFile(filename, avg_data[np.newaxis, :])  # append the average data row to the .txt file
-        else:
-            # if we are not using batch averaging, we append the whole data part to the all_batches_data
-            all_batches_data.extend(filtered_data_part)
+                # if we are not using batch averaging, the shots are added to the running statistics of the channel
+                channel_stats[ch].update(filtered_data_part)
 
-            AppendToTXTFile(filename, filtered_data_part)  # append the whole data array to the .txt file
+                AppendToDataFile(filenames[ch], file_format, filtered_data_part)  # append the whole data array to the data file
     
-        print(f"Batch {i // max_batch_size + 1} processed successfully")
-        time.sleep(1)  # wait for a bit to avoid overwhelming the server
+        print(f"Batch {expected_batch_index} processed successfully, {disk_writer.depth()} writes waiting for the disk")
+
+    if expected_batch_index != (number_of_experiments + max_batch_size - 1) // max_batch_size:
+        raise RuntimeError(f"Stream ended after {expected_batch_index} batches")
     
-    all_batches_data = np.array(all_batches_data)  # convert the list of arrays to a single numpy array
+    # time spent decoding the stream on this computer
+    decode_stats = decoder.stats()
+    print(f"Decoded {decode_stats['frames']} frames ({decode_stats['bytes'] / 1e6:.1f} MB) in {decode_stats['decode_seconds'] * 1e3:.1f} ms, at most {decode_stats['max_decode_seconds'] * 1e3:.2f} ms per frame")
 
-    # calculate the grand average of all batches
-    if use_batch_average:
-        grand_average = np.mean(all_batches_data, axis=0)[0]
-    else:
-        grand_average = np.mean(all_batches_data, axis=0)
+    for ch in read_channels:
+        # the grand average of all batches, weighted by the number of experiments in each batch
+        grand_average = channel_stats[ch].mean
+        print(f"Channel {ch}: {channel_stats[ch].count} experiments, mean standard deviation of a sample: {np.mean(np.sqrt(channel_stats[ch].variance())):.3f}")
 
-    # append the final average data and the time row to the .txt file
-    AppendToTXTFile(filename, grand_average[np.newaxis, :])
-    AppendToTXTFile(filename, time_row[np.newaxis, :])
+        # append the final average data and the time row to the data file
+        AppendToDataFile(filenames[ch], file_format, grand_average[np.newaxis, :], kind = "average")
+        AppendToDataFile(filenames[ch], file_format, time_row[np.newaxis, :], kind = "time")
 
-    # plot the final readout and PSD of the averaged data
-    PlotReadout(grand_average, time_row, filename, number_of_experiments, 9999)
-    PlotPSD(grand_average, filename, fs, number_of_experiments, 9999)
 
-    # calculate the SNR of the averaged data
-    snr, snr_dB = CalculateSNR(grand_average)
-    print(f"SNR (linear): {snr:.2f}, SNR (dB): {snr_dB:.2f} dB")
+        # plot the final readout and PSD of the averaged data
+        PlotReadout(grand_average, time_row, filenames[ch], number_of_experiments, ch)
+        PlotPSD(grand_average, filenames[ch], fs / decimation, number_of_experiments, ch)
 
-    if channel == 0:
+        # calculate the SNR of the averaged data
+        snr, snr_dB = CalculateSNR(grand_average, time_row)
+        print(f"Channel {ch} SNR (linear): {snr:.2f}, SNR (dB): {snr_dB:.2f} dB")
+
+    # wait for the writer thread, the data files are complete and closed after this
+    write_stats = disk_writer.finish()
+    print(f"Wrote {write_stats['bytes'] / 1e6:.1f} MB in {write_stats['write_seconds'] * 1e3:.1f} ms, the stream waited {write_stats['wait_seconds'] * 1e3:.1f} ms for the disk, at most {write_stats['max_depth']} of {disk_writer.capacity} writes queued")
+
+    if channel in [0, "both"]:
         RampMagnet(magnet_inst, 0.0, 0.2)  # turn off the magnet after all experiments are done
 
         TurnOffLO(LO_inst)  # turn off the local oscillator after all experiments are done
@@ -619,7 +764,7 @@ if __name__ == "__main__":
         main(
             timestamp = timestamp,                                      # current time, labeling purposes
             sample = "2024-Feb-Argn-YIG-2_5b-b1",                       # sample name, labeling purposes
-            channel = 0,                                                # which ADC channel to read, 0 for ADC_D (sample), 1 for ADC_C (loopback). in the loopback mode, LO and the magnet are disabled
+            channel = 0,                                                # which ADC channel to read, 0 for ADC_D (sample), 1 for ADC_C (loopback) or "both" for the two in one run. in the loopback mode, LO and the magnet are disabled
             pulse_type = "flat_top",                                    # type of the pulse, can be "gaussian", "flat_top" or "const"
             pulse_frequency = 120,                                      # pulse frequency in MHz, same for both DACs
             pulse_width = 10,                                           # pulse width in "weird" units, see the comments in the main function  
@@ -633,13 +778,20 @@ if __name__ == "__main__":
             number_of_experiments = 1000,                               # total number of experiments
             max_batch_size = 1000,                                      # maximum number of experiments in one batch (in one go)
             use_batch_average = False,                                  # whether to average batches of experiments or not
-            note = "new pulse freq test run, with amplifiers and BPF"   # notes for the experiment, labeling purposes
+            note = "new pulse freq test run, with amplifiers and BPF",  # notes for the experiment, labeling purposes
+            stream_format = "binary",                                   # format of the data stream, "binary" frames or "json" text
+            window_start = None,                                        # start of the readout window in ns, None for the whole readout
+            window_stop = None,                                         # end of the readout window in ns, None for the whole readout
+            decimation = 1,                                             # decimation factor of the readout on the board, 1 for the full 4.4 GS/s
+            file_format = "binary"                                      # format of the data files, "binary" .pgd files (see data_format.py) or "txt"
         )
     finally:
         RampMagnet(magnet_instance, 0.0, 0.2)  # double check that the magnet is turned off
 
         TurnOffLO(LO_instance)  # double check that the local oscillator is turned off
 
+        disk_writer.close() # write what is still queued and close the data files
+
         if isinstance(LO_instance, SC5511A):
             LO_instance.close_device() # close the connection to the SC5511A device, this is needed since it is NOT a VISA device
             print("LO connection closed")
@@ -0,0 +1,93 @@
+# counters and latency histograms of the board, shown by the /metrics endpoint of server.py
+#
+# the acquisition worker keeps one Metrics instance for its process and times every stage of a job
+# (program compile, acquisition, encoding and the write to the server), and server.py keeps its own
+# for what happens on its side (bytes streamed to the clients). both are plain dictionaries when
+# exported, so the snapshot of the worker can be sent through its result queue.
+
+import threading
+import time
+import os
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets in seconds, from 100 us to 100 s
+BUCKETS = [1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # the last bucket collects everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def export(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "buckets": {str(bound): count for bound, count in zip(BUCKETS + ["inf"], self.counts)}
+        }
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock() # the server updates its metrics from several request threads
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        # time the code inside the with block as one observation of the given stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def export(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {name: histogram.export() for name, histogram in self.histograms.items()}
+            }
+
+def ProcessRSS(pid = None):
+
+    """
+    This function returns the resident memory of a process in bytes, read from /proc.
+    It returns None where /proc is not available.
+    """
+
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024 # the value is in kB
+    except OSError:
+        return None
+    return None
+
+# one instance per process, filled by the acquisition scripts when they run inside the worker
+metrics = Metrics()
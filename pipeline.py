@@ -0,0 +1,70 @@
+# producer/consumer pipeline of the pulser scripts, acquisition in one thread and encoding in the other
+#
+# without the pipeline the board does nothing while a batch is encoded and written, and the encoder does
+# nothing while the board acquires. here the batches are acquired by a background thread and handed over
+# through a bounded queue, so the next batch is already being acquired while the previous one is encoded.
+# the FPGA does its work in hardware and numpy releases the GIL for the large copies, so the two stages
+# really overlap on the ARM cores of the board.
+#
+# the acquisition reuses its shot buffers, so it needs a ring of PIPELINE_DEPTH + 2 of them: one being
+# filled, up to PIPELINE_DEPTH waiting in the queue and one being encoded.
+
+import queue
+import threading
+import time
+
+from metrics import metrics
+
+PIPELINE_DEPTH = 1 # batches waiting between acquisition and encoding
+RING_BUFFERS = PIPELINE_DEPTH + 2 # shot buffers needed by the acquisition
+
+def Pipelined(batches, depth = PIPELINE_DEPTH):
+
+    """
+    This function runs a batch generator in a background thread and yields the same batches. At most depth
+    batches wait in between, beyond that the acquisition blocks until the encoder catches up (the time it
+    blocks is kept in the "backpressure" metric). An exception of the generator is raised here, and if the
+    caller stops reading, e.g. because the job was cancelled, the generator is stopped at its next batch.
+    """
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # wait for room in the queue, unless the consumer is gone
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                metrics.observe("backpressure", time.perf_counter() - start)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(("batch", batch)):
+                    break
+            else:
+                put(("done", None))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            batches.close() # the generator belongs to this thread, so it is closed here
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            kind, content = items.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise content
+            yield content
+    finally:
+        stop.set()
+        thread.join() # the board is free again only once the running acquisition is over
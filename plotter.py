@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog, messagebox
 import os
+from data_format import DataFile, EXTENSION
 
 class RowSelectPlotter:
     def __init__(self, root):
@@ -53,7 +54,7 @@ class RowSelectPlotter:
         ttk.Button(btn_frame, text="Clear All", command=self.clear_all).pack(side=tk.LEFT, padx=2)
     
     def add_files(self):
-        new_files = filedialog.askopenfilenames(filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        new_files = filedialog.askopenfilenames(filetypes=[("Data files", "*" + EXTENSION + " *.txt"), ("All files", "*.*")])
         if new_files:
             for f in new_files:
                 self.files.append(f)
@@ -107,10 +108,16 @@ class RowSelectPlotter:
         
         for i, file in enumerate(self.files):
             try:
-                data = np.loadtxt(file, delimiter=',')
-            
-                x_data = data[x_idx] if x_idx >= 0 else data[x_idx]
-                y_data = data[y_idx] if y_idx >= 0 else data[y_idx]
+                if file.endswith(EXTENSION):
+                    # only the two rows are read from the disk, through the memory map of the file
+                    with DataFile(file) as data:
+                        x_data = np.array(data.row(x_idx))
+                        y_data = np.array(data.row(y_idx))
+                else:
+                    data = np.loadtxt(file, delimiter=',')
+                
+                    x_data = data[x_idx] if x_idx >= 0 else data[x_idx]
+                    y_data = data[y_idx] if y_idx >= 0 else data[y_idx]
                 
                 ax.plot(
                     x_data,
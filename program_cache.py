@@ -0,0 +1,86 @@
+# cache of compiled QICK programs living inside the acquisition worker
+#
+# compiling a PulseSequence and generating its waveforms takes a noticeable time on the board,
+# and sweeps or repeated runs usually send the exact same pulse configuration again and again.
+# programs are kept here keyed by a hash of their normalized config, with LRU eviction.
+
+import hashlib
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+def ConfigKey(program_class, config):
+
+    """
+    This function creates the cache key of a program. It takes the program class and its config,
+    and returns a hash of the normalized config. The gate set is left out since it is generated
+    from the other config entries anyway.
+    """
+
+    def normalize(value):
+        # numpy scalars and arrays are not JSON serializable, convert them to plain python values
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        raise TypeError(f"Cannot normalize {type(value)} for the program cache key")
+
+    normalized = {key: value for key, value in config.items() if key != "gate_set"}
+    text = json.dumps([program_class.__module__, program_class.__name__, normalized], sort_keys=True, default=normalize)
+
+    return hashlib.sha1(text.encode()).hexdigest()
+
+class ProgramCache:
+
+    def __init__(self, max_size = 16):
+        self.max_size = max_size
+        self.programs = OrderedDict() # key -> compiled program, ordered from least to most recently used
+        self.loaded = None # the program whose waveforms are currently uploaded to the board
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, program_class, config):
+        # return the cached program for this config, or None if it has to be compiled
+        key = ConfigKey(program_class, config)
+        prog = self.programs.get(key)
+
+        if prog is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.programs.move_to_end(key)
+        return prog
+
+    def put(self, program_class, config, prog):
+        key = ConfigKey(program_class, config)
+        self.programs[key] = prog
+        self.programs.move_to_end(key)
+
+        # evict the least recently used programs if the cache is full
+        while len(self.programs) > self.max_size:
+            _, evicted = self.programs.popitem(last=False)
+            self.evictions += 1
+            if evicted is self.loaded:
+                self.loaded = None
+
+    def needs_upload(self, prog):
+        # the waveform memory holds the pulses of the last loaded program only
+        return prog is not self.loaded
+
+    def mark_loaded(self, prog):
+        self.loaded = prog
+
+    def stats(self):
+        return {
+            "size": len(self.programs),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# one cache per process, shared by the raw and decimated programs since they share the board's waveform memory
+program_cache = ProgramCache()
@@ -0,0 +1,75 @@
+# running mean and variance of a stream of equally shaped arrays (Welford's algorithm)
+#
+# used on the board to reduce a batch of shots to its mean and variance without keeping the shots,
+# and by the host scripts for the grand average of a run, in constant memory whatever the number of experiments
+
+import numpy as np
+
+class RunningStats:
+
+    def __init__(self, extrema = False):
+        self.count = 0
+        self.mean = None
+        self.m2 = None # sum of squared differences from the current mean
+        self.extrema = extrema # if True, the elementwise minimum and maximum are kept as well
+        self.min = None
+        self.max = None
+
+    def add(self, sample):
+        # add a single shot
+        sample = np.asarray(sample, dtype=np.float64)
+
+        if self.count == 0:
+            self.mean = np.zeros_like(sample)
+            self.m2 = np.zeros_like(sample)
+
+        self.count += 1
+        delta = sample - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (sample - self.mean)
+        self.update_extrema(sample, sample)
+
+    def update(self, samples):
+        # add a whole batch of shots at once, indexed by (shot, ...), by merging its statistics (Chan et al.)
+        samples = np.asarray(samples, dtype=np.float64)
+        count = samples.shape[0]
+        if count == 0:
+            return
+
+        batch_mean = samples.mean(axis=0)
+        batch_m2 = ((samples - batch_mean) ** 2).sum(axis=0)
+        self.combine(count, batch_mean, batch_m2)
+
+        if self.extrema:
+            self.update_extrema(samples.min(axis=0), samples.max(axis=0))
+
+    def merge(self, count, mean, variance):
+        # add a batch that was already reduced to its count, mean and (population) variance, e.g. by the board.
+        # the extrema of its shots are not known, so min and max are left as they are
+        if count == 0:
+            return
+        mean = np.asarray(mean, dtype=np.float64)
+        self.combine(count, mean, np.asarray(variance, dtype=np.float64) * count)
+
+    def combine(self, count, batch_mean, batch_m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, batch_mean, batch_m2
+            return
+
+        total = self.count + count
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def update_extrema(self, low, high):
+        if not self.extrema:
+            return
+        self.min = low.copy() if self.min is None else np.minimum(self.min, low)
+        self.max = high.copy() if self.max is None else np.maximum(self.max, high)
+
+    def variance(self):
+        # population variance of the shots added so far
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
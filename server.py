@@ -1,13 +1,30 @@
 from flask import Flask, request, jsonify, Response
-import subprocess
-import json
+from worker import AcquisitionWorker
+from jobs import JobManager, QueueFull
+from metrics import metrics, ProcessRSS
+from tcp_stream import StreamServer
+import math
 
 app = Flask(__name__) # create a Flask app
 
+# the worker keeps QickSoc alive between requests, so the overlay is loaded only once
+worker = AcquisitionWorker()
+
+# jobs run on the worker one by one, independently of the client connections. the scheduler
+# makes sure only one of them drives the board at a time, even with several lab computers sending requests
+jobs = JobManager(worker)
+
+def QueueFullResponse(error):
+    # 429 response telling the client when to try again
+    retry_after = max(1, math.ceil(error.retry_after))
+    return jsonify({"error": str(error), "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
+
 # need a specific auth keyword to run, just a pinch of safety
+AUTH = "magnetism@ESB165"
+
 @app.before_request
 def check_token():
-    if request.headers.get("auth") != "magnetism@ESB165":
+    if request.headers.get("auth") != AUTH:
         return jsonify({"error": "unauthorized"}), 401
 
 # actual code that will be run if a request is sent to /run
@@ -18,53 +35,33 @@ def run():
         # get the input parameters from the request body
         input_json = request.get_json()
 
-        if input_json.get("mode") == "decimated":
-            # if the mode is decimated, run the main_pulser_decimated.py file
-            main_file = "main_pulser_decimated_beta.py"
-
-            # call the main file as a subprocess, this is just for better handling on OS level, use Popen for streaming output
-            proc = subprocess.Popen(
-                ["python3", main_file],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
-            
-            # feed the input JSON to the subprocess, then close the stdin to signal end of input
-            proc.stdin.write(json.dumps(input_json))
-            proc.stdin.close()
-
-            # stream the output of the subprocess back to the client, i.e. the computer running main.py
+        if input_json.get("mode") in ["decimated", "integrated", "raw"]:
+            # the worker runs main_pulser_decimated.py (decimated and integrated modes) or main_pulser.py and streams the output batch by batch.
+            # the job waits in the queue of the scheduler if the board is busy
+            try:
+                job = jobs.submit(input_json, attached=True) # the batches are dropped once they are sent
+            except QueueFull as e:
+                return QueueFullResponse(e)
+            except (TypeError, ValueError): # e.g. "priority": [1]
+                return jsonify({"error": "Invalid priority, number_of_expt or sweep"}), 400
+
+            # wait for the first batch, so that errors during the setup can still be returned as an error response
+            jobs.wait(job)
+            if job.status == "failed":
+                return jsonify({"error": "Script failed", "details": job.error}), 500
+
+            # stream the output of the job back to the client, i.e. the computer running main.py.
+            # if the client goes away before the end, the job is cancelled so the board stops acquiring
             def generate():
-                for line in proc.stdout:
-                    yield line
-
-            return Response(generate(), mimetype="application/json")
-        
-        elif input_json.get("mode") == "raw":
-            # if the mode is raw, run the main_pulser.py file
-            main_file = "main_pulser.py"
-
-            input_data = json.dumps(input_json).encode()
-            
-            # call the main file as a subprocess, this is just for better handling on OS level
-            proc = subprocess.run(
-                ["python3", main_file],
-                input = input_data, # send the parameters from the request body
-                stdout = subprocess.PIPE, # get the output from the subprocess i.e. your main file
-                stderr = subprocess.PIPE, # get the error
-                timeout = 300 # wait for the response from the main file for 6000 secs
-            )
-            
-            # if there is an error, return the error to the client
-            if proc.returncode != 0:
-                return jsonify({"error": "Script failed", "details": proc.stderr.decode()}), 500
-            
-            # if everything is OK, send the output of the main file
-            result = json.loads(proc.stdout.decode())
-            return jsonify(result)
+                try:
+                    for chunk in jobs.stream(job):
+                        # WSGI only takes bytes, so a memoryview of the ring is copied here, once (the TCP stream sends it as it is)
+                        yield bytes(chunk) if isinstance(chunk, memoryview) else chunk
+                finally:
+                    jobs.cancel(job.id)
+
+            mimetype = "application/octet-stream" if job.format == "binary" else "application/json"
+            return Response(generate(), mimetype=mimetype, headers={"X-Job-Id": job.id})
     
         else:
             return jsonify({"error": "Invalid mode specified"}), 400
@@ -72,5 +69,104 @@ def run():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# start a job without waiting for it, the output is read later with /jobs/<id>/stream
+@app.route('/jobs', methods=['POST'])
+
+def submit_job():
+    input_json = request.get_json()
+    if input_json.get("mode") not in ["decimated", "integrated", "raw"]:
+        return jsonify({"error": "Invalid mode specified"}), 400
+
+    try:
+        job = jobs.submit(input_json)
+    except QueueFull as e:
+        return QueueFullResponse(e)
+    except (TypeError, ValueError): # e.g. "priority": [1]
+        return jsonify({"error": "Invalid priority, number_of_expt or sweep"}), 400
+
+    return jsonify(jobs.info(job)), 202
+
+# status of all the jobs known to the board
+@app.route('/jobs', methods=['GET'])
+
+def list_jobs():
+    with jobs.condition:
+        return jsonify([jobs.info(job) for job in jobs.jobs.values()])
+
+# state of the scheduler: the running job, the queued jobs in order and when the board will be idle
+@app.route('/queue', methods=['GET'])
+
+def queue_status():
+    return jsonify(jobs.status())
+
+# status of one job
+@app.route('/jobs/<job_id>', methods=['GET'])
+
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(jobs.info(job))
+
+# output of one job, from_batch lets a client resume after a dropped connection without restarting the job
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+
+def job_stream(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    # a job started by /run or the TCP stream is only sent to the client that started it
+    if job.attached:
+        return jsonify({"error": "The job is streamed to the client that started it"}), 409
+
+    from_batch = request.args.get("from_batch", 0, type=int)
+    if from_batch < job.first_batch:
+        return jsonify({"error": f"Batches before {job.first_batch} are not kept anymore"}), 410
+
+    mimetype = "application/octet-stream" if job.format == "binary" else "application/json"
+    return Response(jobs.stream(job, from_batch), mimetype=mimetype)
+
+# cancel a queued or running job, a finished job is removed together with its kept batches
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+
+def delete_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    if job.is_finished():
+        jobs.remove(job_id)
+    else:
+        jobs.cancel(job_id)
+    return jsonify(jobs.info(job))
+
+# statistics of the acquisition worker, e.g. the hit and miss counts of the compiled program cache
+@app.route('/cache', methods=['GET'])
+
+def cache():
+    return jsonify(worker.stats)
+
+# counters and per-stage latency histograms of the server and of the acquisition worker
+@app.route('/metrics', methods=['GET'])
+
+def get_metrics():
+    status = jobs.status()
+    running = status["running"] is not None
+
+    return jsonify({
+        "shots_per_second": worker.shots_per_second if running else 0.0,
+        "queue_depth": len(status["queued"]),
+        "running": running,
+        "server": dict(metrics.export(), rss_bytes=ProcessRSS()),
+        "worker": dict(worker.metrics, rss_bytes=ProcessRSS(worker.process.pid) if worker.is_alive() else None)
+    })
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5500) # expose to LAN
+    worker.start() # load the overlay once before accepting requests
+    jobs.start()
+    StreamServer(jobs, AUTH).start() # persistent TCP streaming on port 5501, see tcp_stream.py
+    try:
+        app.run(host='0.0.0.0', port=5500, threaded=True) # expose to LAN, threaded so that status requests are served while a job streams
+    finally:
+        worker.stop() # also frees the shared memory of the worker output
@@ -0,0 +1,129 @@
+# shared memory ring buffer between the acquisition worker and server.py
+#
+# the output of a job used to go through the result queue of the worker, i.e. every batch was pickled,
+# written into a pipe, read back and unpickled by the server. now the worker copies every batch into a slot
+# of a shared memory block and only sends the slot number through the queue. a job with a single reader
+# (/run and the TCP stream, see jobs.py) is sent straight from its slot: the server gets a SlotChunk, a
+# memoryview of the slot, which is freed once the chunk is sent. the batches of the other jobs are kept for
+# resuming streams, so the server copies them out of the slot with a single memcpy (read) and frees it at once.
+#
+# the worker fills the slots in order, and a semaphore counting the free slots is all the bookkeeping it needs.
+# the server frees a slot only once the slots before it are free as well, so a chunk sent late (e.g. the batch
+# being sent while the rest of the job is copied out, see JobManager.detach) is never overwritten. a worker
+# with all slots full waits for the server, which gives backpressure.
+
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+class ShmRing:
+
+    def __init__(self, slots = 4, slot_size = 16 << 20):
+        self.slots = slots
+        self.slot_size = slot_size # bigger chunks are sent through the result queue as before
+        self.memory = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.free = mp.Semaphore(slots) # free slots, taken by the worker and given back by the server
+        self.next_slot = 0 # only used by the worker
+        self.lock = mp.Lock() # guards the slots below, the server frees them from several threads
+        self.taken = collections.deque() # slots announced to the server and not freed yet, in order
+        self.done = set() # slots of taken that are not needed anymore, freed once the slots before them are
+
+    def fits(self, chunk):
+        return len(chunk) <= self.slot_size # JSON lines are ASCII, so their length is their size in bytes
+
+    def write(self, chunk, timeout = None):
+
+        """
+        This function copies a chunk (bytes or str) into the next slot and returns (slot, length, is_text),
+        which is sent to the reader instead of the chunk. It returns None if no slot became free within
+        the timeout. Called by the worker only.
+        """
+
+        if not self.free.acquire(timeout=timeout):
+            return None
+
+        is_text = isinstance(chunk, str)
+        data = chunk.encode() if is_text else chunk
+        slot = self.next_slot
+        offset = slot * self.slot_size
+
+        self.memory.buf[offset:offset + len(data)] = data
+        self.next_slot = (slot + 1) % self.slots
+        return slot, len(data), is_text
+
+    def read(self, slot, length, is_text):
+        # copy a chunk out of its slot and free the slot, called by the server only
+        offset = slot * self.slot_size
+        view = self.memory.buf[offset:offset + length]
+        try:
+            return str(view, "ascii") if is_text else bytes(view)
+        finally:
+            view.release()
+            self.release(slot)
+
+    def view(self, slot, length, is_text):
+        # the chunk in its slot without copying it, the slot stays taken until the SlotChunk is released
+        offset = slot * self.slot_size
+        with self.lock:
+            self.taken.append(slot)
+        return SlotChunk(self, slot, self.memory.buf[offset:offset + length], is_text)
+
+    def release(self, slot):
+
+        """
+        This function frees a slot, either read or viewed before or not needed at all (the leftovers of an
+        abandoned job). The worker gets the slot back only once the slots announced before it are free too.
+        Called by the server only.
+        """
+
+        with self.lock:
+            if slot not in self.taken:
+                self.taken.append(slot) # read or skipped, i.e. never viewed
+            self.done.add(slot)
+            while self.taken and self.taken[0] in self.done:
+                self.done.discard(self.taken.popleft())
+                self.free.release()
+
+    def close(self):
+        # called by the server, which created the shared memory
+        try:
+            self.memory.close()
+        except BufferError:
+            pass # a SlotChunk is still being sent, the memory is unmapped once it is gone
+        self.memory.unlink()
+
+class SlotChunk:
+
+    # a chunk of the worker output left in its slot of the ring, sent to the client as a memoryview (buffer()).
+    # release() frees the slot once the chunk is sent, detach() copies it out first if it has to be kept longer
+
+    def __init__(self, ring, slot, view, is_text):
+        self.ring = ring
+        self.slot = slot
+        self.view = view
+        self.is_text = is_text
+        self.data = None # the copy made by detach()
+
+    def __len__(self):
+        return len(self.view) if self.view is not None else len(self.data)
+
+    def buffer(self):
+        # the bytes to send, the slot itself unless detached
+        return self.view if self.view is not None else self.data
+
+    def is_batch(self):
+        # a binary frame, or a JSON line of a batch as opposed to the brackets around them
+        return not self.is_text or self.buffer()[:1] == b"{"
+
+    def detach(self):
+        # copy the chunk out of its slot and free the slot
+        if self.view is not None:
+            self.data = bytes(self.view)
+            self.release()
+
+    def release(self):
+        # free the slot, the chunk must not be used anymore unless it was detached
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            self.ring.release(self.slot)
@@ -0,0 +1,176 @@
+# incremental decoder of the output stream of the board, used by the host scripts
+#
+# the stream is fed in chunks as they arrive (e.g. response.iter_content of requests) and every complete
+# batch is decoded exactly once, so the cost is linear in the size of the stream:
+#   - "binary": wire_format frames. once the prefix of a frame has arrived its length is known, so the rest
+#     is copied into a buffer of exactly that size and decoded when it is full, without any searching
+#   - "json": one JSON object per line. only the new bytes are searched for the end of the line, and the
+#     pieces of a line are joined once it is complete. the brackets around the batches are skipped
+# a batch that cannot be decoded raises ValueError instead of being skipped. the time spent decoding every
+# frame is measured, see StreamDecoder.stats().
+
+import json
+import time
+
+from wire_format import MAGIC, PREFIX, DecodeFrame
+
+READ_SIZE = 1 << 16 # largest chunk read from the connection at once, in bytes
+
+class StreamDecoder:
+
+    def __init__(self, stream_format = "binary"):
+        if stream_format not in ["binary", "json"]:
+            raise ValueError(f"Invalid stream format: {stream_format}")
+
+        self.stream_format = stream_format
+        self.prefix = bytearray() # binary: the prefix of the next frame, while it is incomplete
+        self.frame = None # binary: header and payload of the current frame, allocated once its length is known
+        self.header_length = 0
+        self.filled = 0
+        self.pieces = [] # json: the pieces of the current line
+        self.line = None # json: the last decoded line
+
+        self.frames = 0
+        self.bytes = 0
+        self.decode_seconds = 0.0
+        self.max_decode_seconds = 0.0
+        self.last_decode_seconds = 0.0
+
+    def feed(self, data):
+
+        """
+        This function takes the next chunk of the stream (bytes, bytearray or memoryview) and returns
+        the list of frames it completed: (header, arrays) for binary frames, dictionaries for JSON lines.
+        """
+
+        self.bytes += len(data)
+        frames = []
+
+        if self.stream_format == "json":
+            self.feed_lines(bytes(data), frames)
+            return frames
+
+        view = memoryview(data)
+        while len(view):
+            view = self.feed_binary(view, frames)
+        return frames
+
+    def feed_binary(self, view, frames):
+        # consume the start of view, returns the rest
+        if self.frame is None:
+            missing = PREFIX.size - len(self.prefix)
+            self.prefix += view[:missing]
+            view = view[missing:]
+            if len(self.prefix) < PREFIX.size:
+                return view
+
+            magic, self.header_length, payload_length = PREFIX.unpack(self.prefix)
+            self.prefix = bytearray()
+            if magic != MAGIC:
+                raise ValueError(f"Invalid frame magic: {bytes(magic)!r}")
+            self.frame = bytearray(self.header_length + payload_length)
+            self.filled = 0
+
+        count = min(len(self.frame) - self.filled, len(view))
+        self.frame[self.filled:self.filled + count] = view[:count]
+        self.filled += count
+
+        if self.filled == len(self.frame):
+            frame = memoryview(self.frame)
+            self.frame = None
+            frames.append(self.decode(DecodeFrame, frame[:self.header_length], frame[self.header_length:]))
+
+        return view[count:]
+
+    def feed_lines(self, data, frames):
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                if start < len(data):
+                    self.pieces.append(data[start:])
+                return
+
+            self.pieces.append(data[start:end])
+            start = end + 1
+            self.decode_line()
+            if self.line is not None:
+                frames.append(self.line)
+
+    def decode_line(self):
+        line = b"".join(self.pieces).strip()
+        self.pieces = []
+        self.line = None
+
+        if not line.startswith(b"{"):
+            return # the opening and closing brackets of the stream
+
+        try:
+            self.line = self.decode(json.loads, line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Batch {self.frames + 1} of the stream could not be decoded: {e}")
+
+    def decode(self, function, *args):
+        # call the decoding function and keep its time
+        start = time.perf_counter()
+        result = function(*args)
+        self.last_decode_seconds = time.perf_counter() - start
+
+        self.frames += 1
+        self.decode_seconds += self.last_decode_seconds
+        self.max_decode_seconds = max(self.max_decode_seconds, self.last_decode_seconds)
+        return result
+
+    def finish(self):
+
+        """
+        This function is called at the end of the stream. It returns the last JSON line if the stream
+        did not end with a newline, and raises EOFError if the stream ended in the middle of a frame.
+        """
+
+        if self.stream_format == "json":
+            self.decode_line()
+            return [self.line] if self.line is not None else []
+
+        if self.frame is not None or self.prefix:
+            raise EOFError("Stream ended in the middle of a frame")
+        return []
+
+    def stats(self):
+        # decoding statistics of the stream so far, times in seconds
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "decode_seconds": self.decode_seconds,
+            "mean_decode_seconds": self.decode_seconds / self.frames if self.frames else None,
+            "max_decode_seconds": self.max_decode_seconds
+        }
+
+def DecodeChunks(chunks, decoder):
+
+    """
+    This function feeds an iterable of chunks, e.g. response.iter_content(chunk_size=READ_SIZE) of requests,
+    into the decoder and yields every decoded frame as soon as it is complete.
+    """
+
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.finish()
+
+def DecodeStream(stream, decoder, read_size = READ_SIZE):
+
+    """
+    This function reads a file-like stream (e.g. a socket file) through a single fixed-size buffer and
+    yields every decoded frame like DecodeChunks. The decoder copies what it keeps, so the buffer is reused.
+    """
+
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    readinto = getattr(stream, "readinto1", stream.readinto) # readinto1 returns what is available instead of waiting for a full buffer
+
+    while True:
+        count = readinto(buffer)
+        if not count:
+            break
+        yield from decoder.feed(view[:count])
+    yield from decoder.finish()
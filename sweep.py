@@ -0,0 +1,68 @@
+# frequency and amplitude sweeps, shared by main_pulser.py and main_pulser_decimated.py
+#
+# a sweep is sent in the request as {"parameter": "freq" or "gain", "start": ..., "stop": ..., "step": ...}.
+# freq is in MHz and gain in DAC units, like "freq" and "amplitude" of the request, and the stop value
+# is included. every sweep point gets number_of_expt experiments, and every batch sent back is tagged
+# with the sweep_index and the sweep_value of its point.
+
+import numpy as np
+
+MAX_SWEEP_POINTS = 10000
+
+# allowed range of each parameter, same as the safety checks of the pulser scripts
+LIMITS = {"freq": (0, 9800), "gain": (0, 32767)}
+
+def SweepPoints(sweep):
+
+    """
+    This function returns the values of a sweep as a numpy array. It raises ValueError if
+    the sweep is invalid, e.g. the step does not lead from start to stop.
+    """
+
+    if not isinstance(sweep, dict):
+        raise ValueError("The sweep must be an object with parameter, start, stop and step")
+
+    parameter = sweep.get("parameter")
+    if parameter not in LIMITS:
+        raise ValueError(f"Invalid sweep parameter: {parameter}, must be one of {list(LIMITS)}")
+
+    for key in ["start", "stop", "step"]:
+        if sweep.get(key) is None:
+            raise ValueError(f"The sweep is missing {key}")
+    try:
+        start, stop, step = float(sweep["start"]), float(sweep["stop"]), float(sweep["step"])
+    except (TypeError, ValueError):
+        raise ValueError("The sweep start, stop and step must be numbers")
+    if step == 0 or (stop - start) / step < 0:
+        raise ValueError("The sweep step must be nonzero and lead from start to stop")
+
+    count = int(np.floor((stop - start) / step + 1e-9)) + 1 # the small tolerance keeps stop in when it is a multiple of step
+    if count > MAX_SWEEP_POINTS:
+        raise ValueError(f"Too many sweep points: {count}, the maximum is {MAX_SWEEP_POINTS}")
+
+    values = start + step * np.arange(count)
+    if parameter == "gain":
+        values = np.round(values) # the gain register holds integers
+
+    low, high = LIMITS[parameter]
+    if values.min() < low or values.max() > high:
+        raise ValueError(f"Sweep of {parameter} must stay between {low} and {high}")
+
+    return values
+
+def SweepConfig(config, parameter, value):
+
+    """
+    This function returns a copy of a pulser config with the swept parameter set to the given value,
+    for both generator channels.
+    """
+
+    config = dict(config)
+    if parameter == "freq":
+        config["q1_pulse_freq"] = float(value)
+        config["q2_pulse_freq"] = float(value)
+    else:
+        config["pi_gain"] = int(value)
+        config["pi_2_gain"] = int(value)
+
+    return config
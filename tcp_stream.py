@@ -0,0 +1,173 @@
+# persistent TCP streaming endpoint of the board, next to the HTTP endpoints of server.py
+#
+# every message on the connection, in both directions, is a frame of wire_format.py, so it carries its own
+# length and no HTTP framing or line splitting is needed. a connection can run any number of jobs one after
+# another, which saves the connection setup of every run:
+#   client -> board: {"message": "run", "auth": ..., "request": {...}}, the request is the same as for /run
+#   board -> client: {"message": "job", "id": ...} or {"message": "error", "error": ..., "retry_after": ...}
+#                    then the batch frames of the job exactly as in the binary format of /run,
+#                    then {"message": "end", "status": ..., "error": ...}
+# the control frames have no arrays and are told apart from the batches by their "message" key. the board only
+# accepts control frames with a header of at most MAX_CONTROL_HEADER bytes and no payload, checked before the
+# frame is read (i.e. before the auth token), anything else closes the connection.
+# jobs sent this way go through the same scheduler as the HTTP jobs, so they can also be watched with /jobs.
+
+import socket
+import socketserver
+import threading
+
+from wire_format import EncodeFrame, ReadFrames
+from stream_decoder import StreamDecoder, DecodeStream
+
+PORT = 5501
+MAX_CONTROL_HEADER = 64 << 10 # bytes, a run request is well below 1 KiB
+
+class StreamHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # batches are sent as soon as they are ready
+
+    def send(self, header):
+        self.wfile.write(EncodeFrame(header, {}))
+
+    def requests(self):
+        # the control frames of the client, the lengths in the prefix of a frame are checked before anything is
+        # allocated for it, so a client cannot make the board allocate gigabytes by announcing them
+        try:
+            for header, _ in ReadFrames(self.rfile, MAX_CONTROL_HEADER, max_payload_length=0):
+                yield header
+        except EOFError:
+            return # the client went away in the middle of a frame
+        except ValueError as e:
+            self.send({"message": "error", "error": f"Invalid control frame: {e}"}) # the connection is closed after it
+
+    def handle(self):
+        from jobs import QueueFull # imported here, jobs.py is only needed on the board
+
+        jobs = self.server.jobs
+        for header in self.requests():
+            if header.get("auth") != self.server.auth:
+                self.send({"message": "error", "error": "unauthorized"})
+                return
+
+            data = header.get("request") or {}
+            if header.get("message") != "run" or data.get("mode") not in ["decimated", "integrated", "raw"]:
+                self.send({"message": "error", "error": "Invalid mode specified"})
+                continue
+
+            try:
+                job = jobs.submit(dict(data, format="binary"), attached=True) # the socket only carries binary frames, sent batches are dropped
+            except QueueFull as e:
+                self.send({"message": "error", "error": str(e), "retry_after": e.retry_after})
+                continue
+            except (TypeError, ValueError): # e.g. "priority": [1]
+                self.send({"message": "error", "error": "Invalid priority, number_of_expt or sweep"})
+                continue
+
+            self.send({"message": "job", "id": job.id})
+            try:
+                for chunk in jobs.stream(job):
+                    self.wfile.write(chunk) # most batches are memoryviews of the ring of the worker, sent without a copy
+            except OSError:
+                jobs.cancel(job.id) # the client went away, stop acquiring for nobody
+                return
+
+            self.send({"message": "end", "status": job.status, "error": job.error})
+
+class StreamServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, jobs, auth, host = "0.0.0.0", port = PORT):
+        self.jobs = jobs
+        self.auth = auth
+        super().__init__((host, port), StreamHandler)
+
+    def start(self):
+        # serve the connections from a background thread, each connection gets its own thread
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class StreamError(RuntimeError):
+    # raised by StreamClient for a rejected or failed job, retry_after is set if the queue of the board was full
+    def __init__(self, message, retry_after = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class StreamClient:
+
+    # client side of the endpoint, used by the host scripts. the connection is opened on the first run
+    # and then kept for the following runs
+
+    def __init__(self, host, auth, port = PORT, connect_timeout = 10):
+        self.host = host
+        self.port = port
+        self.auth = auth
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.file = None
+        self.frames = None
+        self.decoder = None # decoder of the last run, see stream_decoder.py
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        self.sock.settimeout(None) # a job can wait in the queue of the board for a long time before its first batch
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.file.close() # the socket is only closed once its file is closed as well
+            self.sock.close()
+        self.sock = None
+        self.file = None
+        self.frames = None
+
+    def run(self, data):
+
+        """
+        This function starts a job on the board and returns a generator of its batches as (header, arrays),
+        like wire_format.ReadFrames. It raises StreamError if the board rejects the job. The generator has to
+        be read to the end before the next run, otherwise the connection is closed (and the job cancelled).
+        """
+
+        request = EncodeFrame({"message": "run", "auth": self.auth, "request": data}, {})
+
+        # a kept connection may have been closed by the board in the meantime, so try once more with a new one
+        for attempt in range(2):
+            if self.sock is None:
+                self.connect()
+            try:
+                # every run gets its own decoder, the board sends nothing between the end of a job and the next request
+                self.decoder = StreamDecoder("binary")
+                self.frames = DecodeStream(self.file, self.decoder)
+                self.sock.sendall(request)
+                header, _ = next(self.frames)
+                break
+            except (OSError, StopIteration, EOFError):
+                self.close()
+                if attempt == 1:
+                    raise
+
+        if header.get("message") == "error":
+            if header["error"] == "unauthorized":
+                self.close() # the board closes the connection as well
+            raise StreamError(header["error"], header.get("retry_after"))
+
+        return self.batches()
+
+    def batches(self):
+        finished = False
+        try:
+            for header, arrays in self.frames:
+                if header.get("message") == "end":
+                    finished = True
+                    if header["status"] != "done":
+                        raise StreamError(f"Job {header['status']}: {header['error']}")
+                    return
+                yield header, arrays
+            raise EOFError("The board closed the connection in the middle of a job")
+        finally:
+            if not finished:
+                self.close()
@@ -0,0 +1,42 @@
+# the pulse train loop of main_pulser_decimated.py must not share a register with the loops of the qick base classes
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+qick = pytest.importorskip("qick")
+if not hasattr(qick.RAveragerProgram, "make_program"):
+    pytest.skip("needs the qick library of the board", allow_module_level=True)
+
+import main_pulser_decimated
+
+@pytest.mark.parametrize("program_class", [main_pulser_decimated.PulseSequence, main_pulser_decimated.PulseSweep])
+def test_train_register(program_class):
+    # run make_program of the base class with the instructions recorded instead of compiled
+    prog = program_class.__new__(program_class)
+    calls = []
+    for name in ["regwi", "mathi", "memwi", "loopnz", "label", "pulse", "synci", "trigger", "wait_all", "sync_all", "end"]:
+        setattr(prog, name, lambda *args, name = name, **kwargs: calls.append((name, args)))
+
+    prog.cfg = {"reps": 5, "expts": 3, "pulse_count": 4, "adc_trig_offset": 0, "relax_delay": 1, "step": 1}
+    prog.reps, prog.expts = 5, 3
+    prog.ro_chs = [0]
+    prog.gate_seq = [{"Q1": "X"}]
+    prog.channels = {"Q1": 0}
+    prog.sweep_steps = [(1, 20, 7)]
+    prog.initialize = lambda: None
+    prog.set_gate_registers = lambda q, name: 0
+    prog.gate_cycles = lambda q, name: 10
+    prog.us2cycles = lambda us, **kwargs: 1
+    prog.make_program()
+
+    loops = {args[2]: tuple(args[:2]) for name, args in calls if name == "loopnz"}
+    counters = {tuple(args[:2]) for name, args in calls if name == "memwi"}
+    train = loops.pop("PULSE_TRAIN")
+
+    assert train == (0, main_pulser_decimated.TRAIN_REGISTER)
+    assert train not in loops.values()
+    assert train not in counters
@@ -0,0 +1,25 @@
+# validation of the job requests by server.py, answered before anything is queued for the board
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+pytest.importorskip("flask")
+
+import server
+
+HEADERS = {"auth": server.AUTH}
+REQUEST = {"mode": "raw", "type": "gaussian", "freq": 100, "width": 10, "amplitude": 1000, "pulse_count": 1,
+           "trigger_delay": 1, "number_of_expt": 10, "max_batch_size": 10, "channel": 0, "format": "binary"}
+
+@pytest.mark.parametrize("field", [{"priority": [1]}, {"priority": "high"}, {"number_of_expt": {}}, {"sweep": [1, 2]}])
+@pytest.mark.parametrize("endpoint", ["/jobs", "/run"])
+def test_invalid_job(endpoint, field):
+    response = server.app.test_client().post(endpoint, json=dict(REQUEST, **field), headers=HEADERS)
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid priority, number_of_expt or sweep"}
+    assert not server.jobs.jobs # rejected before it was queued
@@ -0,0 +1,36 @@
+# frames of wire_format.py, and the length limits of ReadFrames for the frames sent by the clients of the board
+
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from wire_format import EncodeFrame, ReadFrames, PREFIX, MAGIC
+
+def test_round_trip():
+    shots = np.arange(12, dtype="<i2").reshape(3, 4)
+    stream = io.BytesIO(EncodeFrame({"batch_index": 0}, {"shots": shots}) + EncodeFrame({"message": "end"}, {}))
+
+    frames = list(ReadFrames(stream))
+
+    assert [header for header, _ in frames] == [{"batch_index": 0}, {"message": "end"}]
+    np.testing.assert_array_equal(frames[0][1]["shots"], shots)
+
+def test_limits_checked_before_reading():
+    # a prefix announcing a huge payload is rejected without reading (or allocating) the rest of the frame
+    stream = io.BytesIO(PREFIX.pack(MAGIC, 16, 8 << 30))
+    with pytest.raises(ValueError, match="payload"):
+        next(ReadFrames(stream, 64 << 10, max_payload_length=0))
+    assert stream.tell() == PREFIX.size
+
+    stream = io.BytesIO(PREFIX.pack(MAGIC, 1 << 31, 0))
+    with pytest.raises(ValueError, match="header"):
+        next(ReadFrames(stream, 64 << 10, max_payload_length=0))
+
+def test_control_frame_within_limits():
+    stream = io.BytesIO(EncodeFrame({"message": "run", "request": {"mode": "raw"}}, {}))
+    assert list(ReadFrames(stream, 64 << 10, max_payload_length=0))[0][0]["message"] == "run"
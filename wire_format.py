@@ -0,0 +1,121 @@
+# binary framed wire format shared by the board scripts and the host scripts
+#
+# every frame is laid out as
+#   magic (4 bytes, b"PGF1") | header length (uint32, little-endian) | payload length (uint64, little-endian)
+#   | JSON header | raw array buffers, one after another
+# the JSON header holds the metadata of the frame (e.g. batch_index) and, under "arrays",
+# the name, dtype and shape of every buffer in the payload, in order.
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"PGF1"
+PREFIX = struct.Struct("<4sIQ") # magic, header length, payload length
+
+def CompactArray(array):
+
+    """
+    This function picks the smallest little-endian dtype that holds the array without loss.
+    ADC samples are integers even when QICK returns them as floats, so they are sent as int16
+    when possible, otherwise as float32.
+    """
+
+    array = np.asarray(array)
+
+    if array.dtype.kind in "iu" and array.size and array.min() >= -32768 and array.max() <= 32767:
+        return array.astype("<i2", copy=False)
+    if array.dtype.kind == "f" and array.size and np.all(np.abs(array) <= 32767) and np.array_equal(array, np.rint(array)):
+        return array.astype("<i2")
+    if array.dtype.kind == "c":
+        return array.astype("<c8", copy=False)
+    return array.astype("<f4", copy=False)
+
+def EncodeFrame(header, arrays):
+
+    """
+    This function encodes one frame. It takes the header dictionary and a dictionary of
+    name -> numpy array, and returns the frame as bytes.
+    """
+
+    buffers = []
+    descriptions = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        descriptions.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape)})
+        buffers.append(memoryview(array).cast("B") if array.size else memoryview(b"")) # empty arrays cannot be cast
+
+    header_bytes = json.dumps(dict(header, arrays=descriptions)).encode()
+    payload_length = sum(buffer.nbytes for buffer in buffers)
+
+    return b"".join([PREFIX.pack(MAGIC, len(header_bytes), payload_length), header_bytes] + buffers)
+
+def DecodeFrame(header_bytes, payload):
+
+    """
+    This function decodes the header and the payload of one frame. The arrays are created
+    with np.frombuffer, so they are views into the payload, not copies.
+    """
+
+    header = json.loads(bytes(header_bytes))
+    arrays = {}
+    offset = 0
+
+    for description in header.pop("arrays"):
+        dtype = np.dtype(description["dtype"])
+        count = int(np.prod(description["shape"], dtype=np.int64))
+        arrays[description["name"]] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(description["shape"])
+        offset += count * dtype.itemsize
+
+    return header, arrays
+
+def ReadExactly(stream, length):
+
+    """
+    This function reads exactly length bytes from a file-like stream (e.g. response.raw of requests).
+    It returns None if the stream ends cleanly before the first byte.
+    """
+
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < length:
+        chunk = stream.read(length - received)
+        if not chunk:
+            if received == 0:
+                return None
+            raise EOFError(f"Stream ended in the middle of a frame ({received} of {length} bytes)")
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
+
+    return buffer
+
+def ReadFrames(stream, max_header_length = None, max_payload_length = None):
+
+    """
+    This function yields (header, arrays) for every frame in the stream until the stream ends. With
+    max_header_length or max_payload_length, a frame announcing longer parts raises ValueError before
+    anything is read or allocated for it, e.g. for the frames that a server receives from its clients.
+    """
+
+    while True:
+        prefix = ReadExactly(stream, PREFIX.size)
+        if prefix is None:
+            return
+
+        magic, header_length, payload_length = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid frame magic: {bytes(magic)!r}")
+        if max_header_length is not None and header_length > max_header_length:
+            raise ValueError(f"Frame header of {header_length} bytes, at most {max_header_length} are allowed")
+        if max_payload_length is not None and payload_length > max_payload_length:
+            raise ValueError(f"Frame payload of {payload_length} bytes, at most {max_payload_length} are allowed")
+
+        header_bytes = ReadExactly(stream, header_length)
+        payload = ReadExactly(stream, payload_length) if payload_length else bytearray()
+        if header_bytes is None or payload is None:
+            raise EOFError("Stream ended in the middle of a frame")
+
+        yield DecodeFrame(header_bytes, payload)
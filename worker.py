@@ -0,0 +1,233 @@
+# persistent acquisition worker running inside the board, started once by server.py
+#
+# creating QickSoc() loads the overlay and configures the whole board, which takes seconds.
+# instead of paying that for every request, this worker creates QickSoc once in its own
+# process and then takes jobs from a queue, streaming the output of each job back to server.py.
+
+import multiprocessing as mp
+import queue
+import threading
+import traceback
+import itertools
+import time
+
+from shm_ring import ShmRing, SlotChunk
+
+class JobCancelled(Exception):
+    pass
+
+def WorkerLoop(job_queue, result_queue, cancel_event, ring):
+
+    """
+    This function is the body of the worker process. It loads the overlay once, then runs
+    the jobs coming from job_queue one by one. Every message sent back to server.py is a tuple of
+    (kind, job_id, content), where kind is "ready", "slot", "data", "metrics", "done", "cancelled" or "error".
+    The output of a job is written into the shared memory ring and announced with a "slot" message, only
+    chunks too big for a slot are sent as "data". A job is stopped at its next batch once cancel_event is set.
+    """
+
+    # the board libraries are imported here so that only the worker process loads them. the import
+    # times are kept in the metrics, since the cold start on the ARM cores of the board is slow
+    import_start = time.perf_counter()
+    from qick import QickSoc # type: ignore
+    qick_time = time.perf_counter() - import_start
+
+    import_start = time.perf_counter()
+    import main_pulser
+    import main_pulser_decimated
+    from program_cache import program_cache
+    from metrics import metrics
+    scripts_time = time.perf_counter() - import_start
+
+    metrics.observe("import_qick", qick_time)
+    metrics.observe("import_scripts", scripts_time) # everything except qick, e.g. drivers/RBSupport.py and numpy
+    with metrics.stage("overlay_load"):
+        soc = QickSoc() # load the overlay, only done once for the lifetime of the worker
+    result_queue.put(("ready", None, metrics.export()))
+
+    while True:
+        job = job_queue.get()
+        if job is None: # None is the shutdown signal
+            break
+
+        job_id, data = job
+        last_report = time.monotonic()
+
+        def emit(text):
+            nonlocal last_report
+
+            # every batch goes through emit, so this is where a cancelled job stops acquiring
+            if cancel_event.is_set():
+                raise JobCancelled()
+
+            with metrics.stage("write"):
+                if ring.fits(text):
+                    # wait for a free slot, i.e. until the server has read enough of the previous batches
+                    slot = ring.write(text, timeout=0.1)
+                    while slot is None:
+                        if cancel_event.is_set():
+                            raise JobCancelled()
+                        slot = ring.write(text, timeout=0.1)
+                    result_queue.put(("slot", job_id, slot))
+                else:
+                    result_queue.put(("data", job_id, text))
+
+            # report the metrics about once a second, so that /metrics is up to date during long jobs
+            if time.monotonic() - last_report > 1:
+                last_report = time.monotonic()
+                result_queue.put(("metrics", job_id, metrics.export()))
+
+        try:
+            if data.get("mode") in ["decimated", "integrated"]:
+                main_pulser_decimated.RunExperiment(soc, data, emit)
+            elif data.get("mode") == "raw":
+                main_pulser.RunExperiment(soc, data, emit)
+            else:
+                raise ValueError("Invalid mode specified")
+
+            result_queue.put(("metrics", job_id, metrics.export()))
+            result_queue.put(("done", job_id, {"program_cache": program_cache.stats()}))
+        except JobCancelled:
+            result_queue.put(("metrics", job_id, metrics.export()))
+            result_queue.put(("cancelled", job_id, None))
+        except Exception:
+            result_queue.put(("metrics", job_id, metrics.export()))
+            result_queue.put(("error", job_id, traceback.format_exc()))
+
+class WorkerError(RuntimeError):
+    pass
+
+class AcquisitionWorker:
+
+    def __init__(self, startup_timeout = 120):
+        self.startup_timeout = startup_timeout # loading the overlay can take a while on the board
+        self.process = None
+        self.lock = threading.Lock() # only one job can talk to the worker at a time
+        self.job_ids = itertools.count()
+        self.stats = {} # statistics sent by the worker at the end of the last job, e.g. program cache hits
+        self.metrics = {} # latest metrics of the worker process, see metrics.py
+        self.shots_per_second = 0.0
+        self.last_shots = None # (time, shot counter) of the previous metrics report, for shots_per_second
+        self.ring = None # shared memory for the output of the jobs, see shm_ring.py
+
+    def start(self):
+        # start the worker process and wait until the overlay is loaded
+        self.job_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.cancel_event = mp.Event()
+        if self.ring is not None:
+            self.ring.close() # a new ring, the free slot count of the old one is lost if the worker died while writing
+        self.ring = ShmRing()
+        self.process = mp.Process(target=WorkerLoop, args=(self.job_queue, self.result_queue, self.cancel_event, self.ring), daemon=True)
+        self.process.start()
+
+        try:
+            kind, _, content = self.result_queue.get(timeout=self.startup_timeout)
+        except queue.Empty:
+            self.process.kill()
+            raise WorkerError("Acquisition worker did not start in time")
+
+        if kind != "ready":
+            raise WorkerError("Acquisition worker failed to start")
+
+        self.update_metrics(content)
+        self.last_shots = None
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.job_queue.put(None)
+            self.process.join(timeout=10)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def cancel(self):
+        # stop the running job at its next batch, the worker itself keeps running
+        if self.process is not None:
+            self.cancel_event.set()
+
+    def run(self, data, copy = True):
+
+        """
+        This function sends a job to the worker and yields the output chunks (text or bytes) as they arrive.
+        With copy=False the chunks that fit a slot of the ring are SlotChunks instead, which the caller
+        has to release once it is done with them (see shm_ring.py).
+        It raises WorkerError if the job fails or the worker dies in the middle of it, and
+        JobCancelled if the job is cancelled. If the caller stops reading (e.g. the client went away),
+        the job is cancelled so that the board does not keep acquiring for nobody.
+        """
+
+        with self.lock:
+            # restart the worker if it died during a previous job, e.g. due to a crash in the drivers
+            if not self.is_alive():
+                self.start()
+
+            job_id = next(self.job_ids)
+            self.last_shots = (time.monotonic(), self.metrics.get("counters", {}).get("shots", 0)) # the rate covers this job only
+            self.cancel_event.clear() # the worker is idle here, so a leftover cancel can only belong to a finished job
+            self.job_queue.put((job_id, data))
+            finished = False
+
+            try:
+                while True:
+                    kind, content = self.receive(job_id, copy)
+
+                    if kind == "data":
+                        yield content
+                        continue
+
+                    finished = True
+                    if kind == "done":
+                        self.stats = content
+                        return
+                    elif kind == "cancelled":
+                        raise JobCancelled()
+                    else:
+                        raise WorkerError(content)
+            finally:
+                if not finished and self.is_alive():
+                    # the caller stopped reading, cancel the job and wait until the worker is idle again
+                    self.cancel()
+                    kind, content = self.receive(job_id, copy)
+                    while kind == "data":
+                        if isinstance(content, SlotChunk):
+                            content.release()
+                        kind, content = self.receive(job_id, copy)
+
+    def receive(self, job_id, copy = True):
+        # wait for the next message of the given job, returns (kind, content)
+        while True:
+            try:
+                kind, msg_job_id, content = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.is_alive():
+                    raise WorkerError("Acquisition worker died during the job")
+                continue
+
+            if kind == "metrics":
+                self.update_metrics(content)
+                continue
+
+            if kind == "slot":
+                # copy the chunk out of the shared memory, which frees the slot for the worker, or hand over the slot itself
+                if msg_job_id != job_id:
+                    self.ring.release(content[0])
+                    continue
+                kind, content = "data", self.ring.read(*content) if copy else self.ring.view(*content)
+
+            # skip the leftovers of a job that was abandoned before it finished
+            if msg_job_id == job_id:
+                return kind, content
+
+    def update_metrics(self, content):
+        # keep the latest metrics of the worker and derive the acquisition rate from the shot counter
+        self.metrics = content
+        now = time.monotonic()
+        shots = content["counters"].get("shots", 0)
+
+        if self.last_shots is not None and now > self.last_shots[0]:
+            self.shots_per_second = (shots - self.last_shots[1]) / (now - self.last_shots[0])
+        self.last_shots = (now, shots)